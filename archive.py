@@ -0,0 +1,204 @@
+"""
+Compressed, append-only archive of the raw API responses. Every page of results
+is appended by archive_page() as one json line ({name, archived_at, n_tweets,
+data, includes}) to the file of the current month, before any user data is
+merged in or fields are dropped, compressed as a separate zstd frame (if
+zstandard is installed) or gzip member. Files are never rewritten, so a crash
+can at most cut off the batch being appended, which readers skip. Json backups
+of earlier versions are imported as batches {name, archived_at, n_tweets, tweets}
+of tweets with the user data already merged in.
+
+If executed directly, lists the archive files or imports the json backups
+written by earlier versions ("<date range> unfiltered <function>.json"):
+
+    python archive.py list
+    python archive.py import <json path> [<json path> ...]
+"""
+
+import io
+import os
+import re
+import gzip
+import time
+import argparse
+import threading
+from glob import glob
+from os.path import basename, getmtime, getsize, join
+from helpers import json_dumps, json_loads, read_list_from_json, JSONDecodeError
+from tweet_cache import user_metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+archive_dir = "./raw_archive"
+zstd_level = 10
+gzip_level = 6
+
+# Extension of newly written files. Both formats are always readable (zstd needs zstandard).
+archive_ext = ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+
+# Errors raised by the cut off end of a file
+truncation_errors = (EOFError, OSError, ValueError, JSONDecodeError) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+_lock = threading.Lock()
+
+
+def archive_path(month=None, directory=archive_dir) -> str:
+    """File holding the batches archived in {month} ("YYYY-MM", default: current month, UTC)."""
+    month = time.strftime("%Y-%m", time.gmtime()) if month is None else month
+    return join(directory, f"raw_{month}{archive_ext}")
+
+
+def archive_files(directory=archive_dir) -> list:
+    """All archive files in {directory}, oldest month first."""
+    paths = glob(join(directory, "raw_*.jsonl.zst")) + glob(join(directory, "raw_*.jsonl.gz"))
+    return sorted(paths)
+
+
+def compress(data) -> bytes:
+    """Compresses {data} as one zstd frame or gzip member, depending on {archive_ext}."""
+    if archive_ext.endswith(".zst"):
+        return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    return gzip.compress(data, compresslevel=gzip_level)
+
+
+def append_page(json_response, name, archived_at=None, path=None) -> str:
+    """
+    Appends the "data" & "includes" of an API response (queried by function {name}) to
+    the archive as one line & one compressed frame. Returns path of the file.
+    """
+    tweets = json_response.get("data", [])
+    fields = {"n_tweets": len(tweets), "data": tweets, "includes": json_response.get("includes", {})}
+    return _append(name, fields, archived_at, path)
+
+
+def append_batch(tweets, name, archived_at=None, path=None) -> str:
+    """
+    Appends {tweets} (queried by function {name}, user data merged in) to the archive as
+    one line & one compressed frame. Returns path of the file.
+    """
+    return _append(name, {"n_tweets": len(tweets), "tweets": tweets}, archived_at, path)
+
+
+def _append(name, fields, archived_at=None, path=None) -> str:
+    """Writes batch {name, archived_at, **fields} to the file of the month of {archived_at} & syncs it."""
+    archived_at = time.time() if archived_at is None else archived_at
+    path = archive_path(time.strftime("%Y-%m", time.gmtime(archived_at))) if path is None else path
+    batch = {"name": name, "archived_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(archived_at)), **fields}
+    data = compress(json_dumps(batch) + b"\n")
+
+    with _lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    return path
+
+
+def open_lines(path):
+    """Binary file object over the decompressed lines of an archive file."""
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"Reading {path} requires zstandard (pip install zstandard).")
+        f = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return gzip.open(path, "rb")
+
+
+def iter_archive(paths=None, names=None):
+    """
+    Yields the archived batches ({name, archived_at, n_tweets, data, includes} or
+    {name, archived_at, n_tweets, tweets}) of {paths} (default: all archive files) in the
+    order they were appended. If {names} is given, only batches queried by these
+    functions. A cut off last batch is skipped.
+    """
+    paths = archive_files() if paths is None else paths
+
+    for path in paths:
+        with open_lines(path) as f:
+            try:
+                for line in f:
+                    batch = json_loads(line)
+                    if names is None or batch["name"] in names:
+                        yield batch
+            except truncation_errors as e:
+                print(f"Skipping cut off end of {path} ({type(e).__name__}).")
+
+
+def iter_archived_tweets(paths=None, names=None):
+    """
+    Yields the tweets of all batches of iter_archive() as dictionaries, like the json backups
+    of earlier versions: the username & {user_metrics} of the author merged in & the batch
+    name as "source" (unless set already). Fields aren't dropped or resolved.
+    """
+    for batch in iter_archive(paths, names):
+        if "tweets" in batch:
+            tweets = batch["tweets"]
+        else:
+            users = {u["id"]: u for u in batch["includes"].get("users", [])}
+            tweets = []
+            for t in batch["data"]:
+                u = users[t["author_id"]]
+                t["username"] = u["username"]
+                for m in user_metrics:
+                    t[m] = u["public_metrics"][m]
+                tweets.append(t)
+        for t in tweets:
+            t.setdefault("source", batch["name"])
+            yield t
+
+
+def backup_name(path) -> str:
+    """Name of the function that queried a json backup of earlier versions, e.g. "get_new_mentions()"."""
+    match = re.search(r"unfiltered (.+)\.json$", basename(path))
+    return match.group(1) if match else basename(path)
+
+
+def import_backups(json_paths, directory=archive_dir) -> int:
+    """
+    Appends json backups of earlier versions to the archive, each as one batch of the
+    month it was written. The json files are left in place. Returns number of tweets.
+    """
+    n_tweets = 0
+    for path in sorted(json_paths, key=getmtime):
+        name = backup_name(path)
+        tweets = read_list_from_json(path)
+        month = time.strftime("%Y-%m", time.gmtime(getmtime(path)))
+        append_batch(tweets, name, archived_at=getmtime(path), path=archive_path(month, directory))
+        n_tweets += len(tweets)
+    return n_tweets
+
+
+def summary(directory=archive_dir) -> list:
+    """Files, batches, tweets & size on disk of the archive in {directory}."""
+    rows = []
+    for path in archive_files(directory):
+        n_batches = n_tweets = 0
+        for batch in iter_archive([path]):
+            n_batches += 1
+            n_tweets += batch["n_tweets"]
+        rows.append({"file": basename(path), "batches": n_batches, "tweets": n_tweets,
+            "mb": round(getsize(path) / 2**20, 2)})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the raw tweet archive or import json backups.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List archive files with their batches, tweets & size.")
+    import_cmd = commands.add_parser("import", help="Append json backups of earlier versions.")
+    import_cmd.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for row in summary():
+            print(f"{row['file']}: {row['batches']} batches, {row['tweets']} tweets, {row['mb']} MB")
+
+    elif args.command == "import":
+        n_tweets = import_backups(args.paths)
+        print(f"Archived {n_tweets} tweets from {len(args.paths)} files. The json files can be deleted.")
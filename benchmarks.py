@@ -0,0 +1,831 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the pandas pipeline. Compares the vectorized functions in
+pandas_pipes.py with the row-wise versions they replaced & checks that both
+produce identical output. Run directly to benchmark a synthetic data set of
+{n_rows} tweets (& writing/loading a csv file of {csv_rows} rows):
+
+    python benchmarks.py [n_rows]
+
+The suite times every stage of main.py & generate_monthly_data.py on synthetic
+corpora of {suite_sizes} rows, measures peak memory per stage & compares the
+results with a saved baseline (exits with status 1 on regressions). API lookups
+are answered by mock_twitter_api.py, all files go to a temporary directory:
+
+    python benchmarks.py suite [--sizes 1000 10000 ...] [--save-baseline] [--no-memory]
+
+The rate limit check replays recorded x-rate-limit-* headers (a json list or a
+run report saved with RECORD_RATE_LIMITS=1, default {rate_limit_recording}) &
+fetches quotes from a rate limited mock API with parallel workers on a simulated
+clock. Exits with status 1 if the limiter lets through any request the API would
+answer with 429:
+
+    python benchmarks.py rate_limits [recording.json ...]
+"""
+
+import os
+import io
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import importlib.util
+import random
+import tracemalloc
+from os.path import exists, join
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+import pandas as pd
+from pandas_pipes import (
+    tweets_to_df,
+    replace_nans,
+    extract_public_metrics,
+    apply_and_concat,
+    public_metrics,
+    points_formula,
+    assign_points,
+    add_followers_per_retweets,
+    add_more_than_5_mentions_flag,
+    add_truncated_text_flag,
+    add_n_mentions,
+    month_key,
+)
+from helpers import csv_to_df, df_to_csv, get_max_from_csv_col
+from storage import upsert_tweets, load_tweets, load_month, rebuild_cutoffs
+from query_and_filter import (
+    get_cutoffs,
+    apply_filters,
+    discount_mentions,
+    get_new_quote_tweets,
+    merge_user_data,
+    de_truncate,
+    filter_patterns,
+    quote_workers,
+)
+from discard_log import DISCARD_LOG
+from tweet_cache import TWEET_CACHE, MEDIA_TAGS, user_metrics
+from http_session import reset_session
+from rate_limiter import RateLimiter, SimulatedClock, load_history, replay_headers
+import query_and_filter
+from main import transform
+from generate_monthly_data import transform as monthly_transform
+import mock_twitter_api
+
+n_rows = 1_000_000
+csv_rows = 3_000_000
+
+# Corpus sizes of the suite. Stages working on tweet dicts (several KB each) are
+# skipped above {dict_rows_limit} rows, the others run on column-wise frames.
+suite_sizes = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+dict_rows_limit = 1_000_000
+baseline_path = "./benchmark_baseline.json"
+
+# Recorded headers replayed by the rate limit check
+rate_limit_recording = "./rate_limit_fixtures/mock_run.json"
+
+# A stage regressed if it got slower (or grew) by more than {tolerance} and by at
+# least {min_regression_s} seconds ({min_regression_mb} MB), to ignore noise on small corpora
+tolerance = 0.25
+min_regression_s = 0.05
+min_regression_mb = 5
+
+
+def synthetic_metrics(n_rows, seed=0) -> pd.DataFrame:
+    """Random frame with the columns used for scoring."""
+    rng = np.random.default_rng(seed)
+    n_mentions = rng.integers(0, 12, n_rows)
+    usernames = np.array([f"user{i}" for i in range(50)])
+
+    return pd.DataFrame({
+        "impression_count": rng.integers(0, 200_000, n_rows),
+        "retweet_count": rng.integers(0, 4, n_rows),
+        "quote_count": rng.integers(0, 3, n_rows),
+        "followers_count": rng.integers(0, 50_000, n_rows),
+        "discounted_mentions": [list(usernames[:k]) for k in n_mentions],
+        "text": np.where(rng.random(n_rows) < 0.1, "Truncated tweet …", "Full tweet"),
+    })
+
+
+def synthetic_table(n_rows, seed=0) -> pd.DataFrame:
+    """Random frame with the dtypes of the tweet database, for csv round trips."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2022-01-01", tz="UTC")
+
+    return pd.DataFrame({
+        "id": (1600000000000000000 + np.arange(n_rows)).astype(str).astype(object),
+        "created_at": start + pd.to_timedelta(rng.integers(0, 365*24*60*60, n_rows), unit="s"),
+        "text": np.where(rng.random(n_rows) < 0.5, "@JediSwap gm", "Swapping on @JediSwap").astype(object),
+        "author_id": rng.integers(1, 10**9, n_rows).astype(str).astype(object),
+        "impression_count": rng.integers(0, 200_000, n_rows),
+        "followers_count": rng.integers(0, 50_000, n_rows),
+        "points": rng.random(n_rows) * 10,
+        "truncated_text": rng.random(n_rows) < 0.1,
+    })
+
+
+def synthetic_tweets(n_rows, seed=0) -> dict:
+    """Random dictionary {id: tweet} shaped like merged API responses."""
+    rnd = random.Random(seed)
+    tweets = {}
+
+    for i in range(n_rows):
+        _id = str(1600000000000000000 + i)
+        tweet = {
+            "id": _id,
+            "edit_history_tweet_ids": [_id],
+            "text": f"@JediSwap tweet number {i}",
+            "created_at": f"2023-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:00:00.000Z",
+            "author_id": str(rnd.randint(1, 1 + n_rows // 5)),
+            "conversation_id": _id,
+            "public_metrics": {m: rnd.randint(0, 5000) for m in public_metrics},
+            "entities": {"mentions": [{"username": "JediSwap"}]},
+            "username": f"user{rnd.randint(1, 1 + n_rows // 5)}",
+            "followers_count": rnd.randint(0, 50_000),
+            "following_count": rnd.randint(0, 5_000),
+            "tweet_count": rnd.randint(0, 10_000),
+            "listed_count": rnd.randint(0, 100),
+            "source": "get_new_mentions()",
+        }
+        if i % 3 == 0:
+            tweet["referenced_tweets"] = [{"type": "quoted", "id": str(1500000000000000000 + i)}]
+        if i % 3 == 1:
+            tweet["referenced_tweets"] = [{"type": "replied_to", "id": str(1500000000000000000 + i)}]
+            tweet["in_reply_to_user_id"] = "1470315931142393857"
+        tweets[_id] = tweet
+
+    return tweets
+
+
+def synthetic_api_response(n_rows, seed=0) -> dict:
+    """Random API response {"data": [tweets], "includes": {"users": [users]}} with all requested fields."""
+    rnd = random.Random(seed)
+    n_users = 1 + n_rows // 5
+    users = [{
+        "id": str(10**9 + i),
+        "name": f"User {i}",
+        "username": f"user{i}",
+        "entities": {"description": {"hashtags": [{"start": 0, "end": 9, "tag": "Starknet"}]}},
+        "public_metrics": {m: rnd.randint(0, 5000) for m in ["followers_count", "following_count", "tweet_count", "listed_count"]},
+    } for i in range(n_users)]
+
+    tweets = []
+    for i in range(n_rows):
+        _id = str(1600000000000000000 + i)
+        mentions = [{"start": 0, "end": 9, "username": "JediSwap", "id": "1470315931142393857"}] + [
+            {"start": 10 + 9*k, "end": 18 + 9*k, "username": f"user{k}", "id": str(10**9 + k)} for k in range(i % 4)
+        ]
+        text = " ".join(f"@{m['username']}" for m in mentions) + f" swapping on Starknet, tweet number {i} https://t.co/abcdefghij"
+        tweet = {
+            "id": _id,
+            "edit_history_tweet_ids": [_id],
+            "text": text,
+            "created_at": f"2023-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:00:00.000Z",
+            "author_id": str(10**9 + rnd.randrange(n_users)),
+            "conversation_id": _id,
+            "public_metrics": {m: rnd.randint(0, 5000) for m in public_metrics},
+            "entities": {
+                "mentions": mentions,
+                "urls": [{"start": 90, "end": 113, "url": "https://t.co/abcdefghij",
+                    "expanded_url": "https://app.jediswap.xyz/#/swap", "display_url": "app.jediswap.xyz/#/swap"}],
+                "annotations": [{"start": 30, "end": 37, "probability": 0.8, "type": "Product", "normalized_text": "Starknet"}],
+            },
+        }
+        if i % 10 == 0:
+            tweet["note_tweet"] = {"text": text + " and a lot more" * 20, "entities": {"mentions": mentions}}
+        if i % 3 == 1:
+            tweet["referenced_tweets"] = [{"type": "replied_to", "id": str(1500000000000000000 + i)}]
+            tweet["in_reply_to_user_id"] = "1470315931142393857"
+        tweets.append(tweet)
+
+    return {"data": tweets, "includes": {"users": users}}
+
+
+# Row-wise implementations replaced by vectorized ones. Kept as reference.
+
+def extract_public_metrics_rowwise(df) -> pd.DataFrame:
+    def extract_from_dict(d) -> tuple:
+        return tuple(d[m] for m in public_metrics)
+    return apply_and_concat(df, 'public_metrics', extract_from_dict, public_metrics)
+
+def normalize_rowwise(tweets) -> pd.DataFrame:
+    df = pd.DataFrame.from_dict(tweets, orient="index")
+    return extract_public_metrics_rowwise(replace_nans(df))
+
+def assign_points_rowwise(df) -> pd.DataFrame:
+    df["points"] = df["impression_count"].apply(points_formula)
+    df.loc[df["followers_count"] < 11, "points"] = 0
+    df.loc[df["impression_count"] < 50, "points"] = 0
+    df.loc[df["n mentions"] > 8, "points"] = 0
+
+    def adjust_points(row):
+        if int(row["n mentions"]) > 3:
+            return int(row["points"] / row["n mentions"])
+        else:
+            return int(row["points"])
+
+    df["points"] = df.apply(adjust_points, axis=1)
+    return df
+
+def add_followers_per_retweets_rowwise(df) -> pd.DataFrame:
+    def f(row):
+        if int(row["retweet_count"]) + int(row["quote_count"]) == 0:
+            return "never retweeted or quoted"
+        else:
+            return int(row["followers_count"] / (row["retweet_count"] + row["quote_count"]))
+
+    df['followers_per_retweets'] = df.apply(f, axis=1)
+    return df
+
+def add_more_than_5_mentions_flag_rowwise(df) -> pd.DataFrame:
+    df[">5 mentions"] = df["discounted_mentions"].apply(lambda l: True if len(l) > 5 else False)
+    return df
+
+def add_truncated_text_flag_rowwise(df) -> pd.DataFrame:
+    df["truncated_text"] = df["text"].apply(lambda t: True if t.find("…") != -1 else False)
+    return df
+
+def add_n_mentions_rowwise(df) -> pd.DataFrame:
+    df["n mentions"] = df["discounted_mentions"].apply(lambda mentions: len(mentions))
+    return df
+
+
+def csv_to_df_reference(csv_path, **kwargs) -> pd.DataFrame:
+    dtypes = {key:value for (key,value) in pd.read_csv(csv_path,
+              nrows=1).iloc[0].to_dict().items() if 'date' not in value}
+    parse_dates = [key for (key,value) in pd.read_csv(csv_path,
+                   nrows=1).iloc[0].to_dict().items() if 'date' in value]
+    return pd.read_csv(csv_path, dtype=dtypes, parse_dates=parse_dates, skiprows=[1], **kwargs)
+
+def df_to_csv_reference(df, csv_path, **kwargs) -> None:
+    df2 = df.copy()
+    df2.reset_index(drop=True, inplace=True)
+    df2.loc[-1] = df2.dtypes
+    df2.index = df2.index + 1
+    df2.sort_index(inplace=True)
+    df2.to_csv(csv_path, index=False, **kwargs)
+
+def get_max_from_csv_col_reference(csv_path, col="id"):
+    return csv_to_df_reference(csv_path)[col].max()
+
+
+def merge_user_data_reference(tweets_list, users_list) -> list:
+    users_dict = {u["id"]: u for u in users_list}
+    for t in tweets_list:
+        u = users_dict[t["author_id"]]
+        t["username"] = u["username"]
+        for m in ["followers_count", "following_count", "tweet_count", "listed_count"]:
+            t[m] = u["public_metrics"][m]
+    return de_truncate(tweets_list)
+
+
+def normalize_columnar(tweets) -> pd.DataFrame:
+    df = tweets_to_df(tweets)
+    return extract_public_metrics(replace_nans(df))
+
+
+scoring_steps = [
+    ("add_n_mentions", add_n_mentions_rowwise, add_n_mentions),
+    ("add_more_than_5_mentions_flag", add_more_than_5_mentions_flag_rowwise, add_more_than_5_mentions_flag),
+    ("add_truncated_text_flag", add_truncated_text_flag_rowwise, add_truncated_text_flag),
+    ("add_followers_per_retweets", add_followers_per_retweets_rowwise, add_followers_per_retweets),
+    ("assign_points", assign_points_rowwise, assign_points),
+]
+
+
+def timed(func, *args) -> tuple:
+    """Returns tuple (result, seconds)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return (result, time.perf_counter() - start)
+
+
+def measured(func, *args) -> tuple:
+    """
+    Returns tuple (result, seconds, peak traced memory in MB). Runs {func} twice,
+    since tracing allocations slows it down too much for timing.
+    """
+    result, seconds = timed(func, *args)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (result, seconds, peak / 2**20)
+
+
+def bench_normalize(n_rows=n_rows) -> list:
+    """Times & measures building the frame incl. public metrics, old vs. new path."""
+    tweets = synthetic_tweets(n_rows)
+    df_rowwise, t_rowwise, mb_rowwise = measured(normalize_rowwise, tweets)
+    df_columnar, t_columnar, mb_columnar = measured(normalize_columnar, tweets)
+
+    # Same data except the nested column the old path keeps (dropped by both pipelines)
+    df_rowwise = df_rowwise.drop(columns="public_metrics")
+    pd.testing.assert_frame_equal(df_rowwise, df_columnar, check_like=True)
+
+    return [
+        {"path": "from_dict + apply_and_concat", "seconds": round(t_rowwise, 3), "peak_mb": round(mb_rowwise, 1)},
+        {"path": "tweets_to_df", "seconds": round(t_columnar, 3), "peak_mb": round(mb_columnar, 1)},
+    ]
+
+
+def bench_scoring(n_rows=n_rows) -> list:
+    """Times row-wise vs. vectorized scoring steps. Asserts identical results."""
+    df = synthetic_metrics(n_rows)
+    df_rowwise, df_vectorized = df.copy(), df.copy()
+    results = []
+
+    for name, rowwise, vectorized in scoring_steps:
+        df_rowwise, t_rowwise = timed(rowwise, df_rowwise)
+        df_vectorized, t_vectorized = timed(vectorized, df_vectorized)
+        pd.testing.assert_frame_equal(df_rowwise, df_vectorized)
+        results.append({
+            "step": name,
+            "rowwise_s": round(t_rowwise, 3),
+            "vectorized_s": round(t_vectorized, 3),
+            "speedup": round(t_rowwise / max(t_vectorized, 1e-9), 1),
+        })
+
+    return results
+
+
+def bench_csv_load(n_rows=csv_rows) -> list:
+    """Times loading a csv database written by df_to_csv(), old vs. new reader. Asserts identical results."""
+    df = synthetic_table(n_rows)
+    csv_dir = tempfile.mkdtemp()
+    csv_path = os.path.join(csv_dir, "tweets.csv")
+    df_to_csv(df, csv_path)
+
+    engines = [None] + (["pyarrow"] if importlib.util.find_spec("pyarrow") else [])
+    results = []
+
+    try:
+        expected, seconds = timed(csv_to_df_reference, csv_path)
+        results.append({"read": "old csv_to_df", "seconds": round(seconds, 3)})
+
+        for engine in engines:
+            loaded, seconds = timed(lambda: csv_to_df(csv_path, engine=engine))
+            pd.testing.assert_frame_equal(expected, loaded)
+            results.append({"read": f"csv_to_df (engine={engine})", "seconds": round(seconds, 3)})
+
+            loaded, seconds = timed(lambda: csv_to_df(csv_path, usecols=["id", "created_at"], engine=engine))
+            pd.testing.assert_frame_equal(expected[["id", "created_at"]], loaded)
+            results.append({"read": f"csv_to_df usecols=2 (engine={engine})", "seconds": round(seconds, 3)})
+
+        expected_max, seconds = timed(get_max_from_csv_col_reference, csv_path)
+        results.append({"read": "old get_max_from_csv_col", "seconds": round(seconds, 3)})
+        max_id, seconds = timed(get_max_from_csv_col, csv_path)
+        assert max_id == expected_max
+        results.append({"read": "get_max_from_csv_col", "seconds": round(seconds, 3)})
+    finally:
+        os.remove(csv_path)
+        os.rmdir(csv_dir)
+
+    return results
+
+
+def bench_csv_write(n_rows=csv_rows) -> list:
+    """Times & measures writing the csv database, old vs. new writer. Asserts identical files."""
+    df = synthetic_table(n_rows)
+    csv_dir = tempfile.mkdtemp()
+    paths = [os.path.join(csv_dir, "old.csv"), os.path.join(csv_dir, "new.csv")]
+
+    try:
+        _, t_old, mb_old = measured(df_to_csv_reference, df, paths[0])
+        _, t_new, mb_new = measured(df_to_csv, df, paths[1])
+        with open(paths[0], "rb") as f_old, open(paths[1], "rb") as f_new:
+            assert f_old.read() == f_new.read()
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(csv_dir)
+
+    return [
+        {"write": "old df_to_csv", "seconds": round(t_old, 3), "peak_mb": round(mb_old, 1)},
+        {"write": "df_to_csv", "seconds": round(t_new, 3), "peak_mb": round(mb_new, 1)},
+    ]
+
+
+def bench_records(n_rows=n_rows) -> list:
+    """
+    Times & measures turning parsed API responses into the tweets the pipeline holds,
+    dicts vs. TweetRecords, & building the DataFrame from them. Asserts identical frames.
+    """
+    results = []
+    frames = []
+
+    for path, merge in [("dicts", merge_user_data_reference), ("TweetRecord", merge_user_data)]:
+        # Collections triggered by the previous path's garbage would dominate the times
+        gc.collect()
+        response = synthetic_api_response(n_rows)
+        tweets, t_merge = timed(merge, response["data"], response["includes"]["users"])
+        del response
+
+        # Memory held by the tweets after parsing, merging & de-truncating
+        tracemalloc.start()
+        response = synthetic_api_response(n_rows)
+        tweets = merge(response["data"], response["includes"]["users"])
+        del response
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        gc.collect()
+        df, t_df = timed(tweets_to_df, tweets)
+        frames.append(df)
+        results.append({"tweets": path, "merge_s": round(t_merge, 3), "tweets_to_df_s": round(t_df, 3),
+            "held_mb": round(held / 2**20, 1)})
+        del tweets
+
+    # Records drop fields the pipeline never uses & keep only what it reads of the entities
+    df_dicts, df_records = frames
+    df_dicts = df_dicts.drop(columns=["edit_history_tweet_ids", "note_tweet", "entities"])
+    df_records = df_records.drop(columns=["entities"])
+    pd.testing.assert_frame_equal(df_dicts, df_records, check_like=True)
+
+    return results
+
+
+def bench_json(n_rows=n_rows) -> list:
+    """
+    Times decoding an API response & encoding its tweets with each installed json
+    library, & compares the size of the old json backups with the compressed archive.
+    """
+    import helpers
+    import archive
+    backends = {"json": (json.loads, lambda obj: json.dumps(obj).encode())}
+    if helpers.orjson is not None:
+        backends["orjson"] = (helpers.orjson.loads, helpers.orjson.dumps)
+    if helpers.msgspec is not None:
+        backends["msgspec"] = (helpers.msgspec.json.decode, helpers.msgspec.json.encode)
+
+    raw = json.dumps(synthetic_api_response(n_rows)).encode()
+    results = []
+    for name, (loads, dumps) in backends.items():
+        # Collections triggered by the previous backend's garbage would dominate the times
+        response = None
+        gc.collect()
+        response, t_decode = timed(loads, raw)
+        _, t_encode = timed(dumps, response["data"])
+        results.append({"backend": name, "decode_s": round(t_decode, 3), "encode_s": round(t_encode, 3)})
+
+    with scratch_dir() as directory:
+        archive_path, t_archive = timed(archive.append_page, response, "bench", None, join(directory, "raw.jsonl.gz"))
+        if archive.archive_ext.endswith(".zst"):
+            archive_path = archive.append_page(response, "bench", None, join(directory, "raw.jsonl.zst"))
+        archived = next(archive.iter_archive([archive_path]))
+        assert (archived["data"], archived["includes"]) == (response["data"], response["includes"])
+
+        # Earlier versions wrote the merged tweet dictionaries, double-encoded
+        tweets = merge_user_data_reference(response["data"], response["includes"]["users"])
+        legacy_path = join(directory, "legacy.json")
+        with open(legacy_path, "w") as f:
+            json.dump(json.dumps(tweets), f)
+        results.append({"backend": f"backup: legacy json {os.path.getsize(legacy_path) / 2**20:.1f} MB, " + \
+            f"archive {os.path.getsize(archive_path) / 2**20:.1f} MB", "encode_s": round(t_archive, 3)})
+
+    return results
+
+
+def synthetic_db_frame(n_rows, seed=0) -> pd.DataFrame:
+    """
+    Random frame shaped like the output of main.transform() after discount_mentions().
+    Built column-wise (list cells shared between rows), so 10M rows fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(rng.integers(0, 365*24*60*60, n_rows))
+    parsed_time = pd.Series(pd.Timestamp("2023-01-01", tz="UTC") + pd.to_timedelta(seconds, unit="s"))
+    ids = (1600000000000000000 + np.arange(n_rows)).astype(str).astype(object)
+    authors = rng.integers(1, 2 + n_rows // 5, n_rows)
+    kinds = rng.integers(0, 3, n_rows).tolist()     # quote, reply, plain mention
+    refs = rng.integers(0, 1000, n_rows).tolist()
+
+    usernames = [f"user{i}" for i in range(50)]
+    mention_lists = [["JediSwap"] + usernames[:k] for k in range(12)]
+    quoted = [[{"type": "quoted", "id": str(1500000000000000000 + i)}] for i in range(1000)]
+    replied = [[{"type": "replied_to", "id": str(1500000000000000000 + i)}] for i in range(1000)]
+
+    in_reply_to = np.full(n_rows, False, dtype=object)
+    in_reply_to[np.array(kinds) == 1] = "1000000001"
+    author_ids = authors.astype(str).astype(object)
+
+    df = pd.DataFrame({
+        "month": month_key(parsed_time),
+        "parsed_time": parsed_time,
+        "id": ids,
+        "conversation_id": ids,
+        "impression_count": rng.integers(0, 200_000, n_rows),
+        "reply_count": rng.integers(0, 20, n_rows),
+        "retweet_count": rng.integers(0, 4, n_rows),
+        "like_count": rng.integers(0, 500, n_rows),
+        "quote_count": rng.integers(0, 3, n_rows),
+        "text": np.where(rng.random(n_rows) < 0.1, "Swapping all day …", "gm").astype(object),
+        "discounted_mentions": [mention_lists[k] for k in rng.integers(0, 12, n_rows).tolist()],
+        "in_reply_to_user_id": in_reply_to,
+        "created_at": (pd.Series(np.datetime_as_string(parsed_time.values.astype("datetime64[ms]"), unit="ms")) + "Z").astype(object),
+        "source": np.where(np.array(kinds) == 0, "get_quotes_for_tweet()", "get_new_mentions()").astype(object),
+        "username": ("user" + pd.Series(author_ids)).astype(object),
+        "author_id": author_ids,
+        "followers_count": rng.integers(0, 50_000, n_rows),
+        "following_count": rng.integers(0, 5_000, n_rows),
+        "tweet_count": rng.integers(0, 10_000, n_rows),
+        "listed_count": rng.integers(0, 100, n_rows),
+        "referenced_tweets": [quoted[r] if k == 0 else replied[r] if k == 1 else False for k, r in zip(kinds, refs)],
+    })
+    return df
+
+
+def discount_input(n_rows, seed=0) -> dict:
+    """synthetic_tweets() with half of the replies going to other accounts than JediSwap."""
+    tweets = synthetic_tweets(n_rows, seed)
+    for i, t in enumerate(tweets.values()):
+        if "in_reply_to_user_id" in t and i % 2:
+            t["in_reply_to_user_id"] = t["author_id"]
+    return tweets
+
+
+def parent_corpus(tweets) -> dict:
+    """Corpus for mock_twitter_api.py holding the parents of all replies in {tweets}. Every 10th is deleted."""
+    corpus = mock_twitter_api.empty_corpus()
+    corpus["users"]["1000000001"] = {"id": "1000000001", "username": "parent_author",
+        "public_metrics": {m: 0 for m in user_metrics}}
+
+    for t in tweets.values():
+        for ref in t.get("referenced_tweets", []):
+            _id = ref["id"]
+            if ref["type"] != "replied_to" or int(_id) % 10 == 0:
+                continue
+            mentions = ["JediSwap", "user1"] if int(_id) % 2 else ["user1"]
+            corpus["tweets"][_id] = {
+                "id": _id,
+                "text": " ".join(f"@{m}" for m in mentions) + " gm",
+                "created_at": "2023-01-01T00:00:00.000Z",
+                "author_id": "1000000001",
+                "public_metrics": {m: 0 for m in public_metrics},
+                "entities": {"mentions": [{"username": m} for m in mentions]},
+            }
+    return corpus
+
+
+@contextmanager
+def scratch_dir():
+    """
+    Runs the enclosed block in a temporary working directory (json backups, checkpoints)
+    with the discard log & tweet cache pointed at files in it. Restores everything after.
+    """
+    cwd = os.getcwd()
+    paths = [(store, store.path) for store in (DISCARD_LOG, TWEET_CACHE, MEDIA_TAGS)]
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        for store, path in paths:
+            store.close()
+            store.path = path
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def cold_stores(directory) -> None:
+    """Points the discard log & tweet cache at new empty files in {directory}."""
+    for store in (DISCARD_LOG, TWEET_CACHE, MEDIA_TAGS):
+        store.close()
+    for name in ("discarded_tweets.sqlite", "tweet_cache.sqlite"):
+        if exists(join(directory, name)):
+            os.remove(join(directory, name))
+    DISCARD_LOG.path = join(directory, "discarded_tweets.sqlite")
+    TWEET_CACHE.path = MEDIA_TAGS.path = join(directory, "tweet_cache.sqlite")
+
+
+def run_stage(func, setup=None, memory=True) -> tuple:
+    """
+    Returns tuple (seconds, peak traced memory in MB or None). Calls {setup} (untimed)
+    before each run for fresh arguments. Like measured(), memory is traced in a 2nd run.
+    """
+    with redirect_stdout(io.StringIO()):
+        _, seconds = timed(func, *(setup() if setup else ()))
+        if not memory:
+            return (seconds, None)
+
+        args = setup() if setup else ()
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return (seconds, peak / 2**20)
+
+
+def bench_suite(n_rows, memory=True) -> list:
+    """Times & measures each stage of main.py & generate_monthly_data.py on {n_rows} synthetic tweets."""
+    results = []
+
+    def record(stage, func, setup=None):
+        seconds, peak_mb = run_stage(func, setup, memory)
+        results.append({"stage": stage, "rows": n_rows, "seconds": round(seconds, 3),
+            "peak_mb": None if peak_mb is None else round(peak_mb, 1)})
+
+    with scratch_dir() as directory:
+        db_path = join(directory, "tweets.sqlite")
+        csv_path = join(directory, "tweets.csv")
+        cold_stores(directory)
+
+        if n_rows <= dict_rows_limit:
+            tweets = synthetic_tweets(n_rows)
+            record("main.transform", lambda: transform(tweets))
+            record("apply_filters", lambda: apply_filters(list(tweets.values()), filter_patterns, None))
+            del tweets
+
+            # Parent tweets are looked up from the mock API, with a cold cache every run
+            api = mock_twitter_api.MockTwitterAPI(parent_corpus(discount_input(n_rows)))
+            mock_twitter_api.install(api)
+
+            def fresh_discount_input():
+                cold_stores(directory)
+                return (discount_input(n_rows),)
+
+            try:
+                record("discount_mentions", discount_mentions, fresh_discount_input)
+            finally:
+                reset_session()
+
+        df = synthetic_db_frame(n_rows)
+
+        def new_db():
+            if exists(db_path):
+                os.remove(db_path)
+            return ()
+
+        record("upsert_tweets (new db)", lambda: upsert_tweets(df, db_path), new_db)
+        record("upsert_tweets (all known)", lambda: upsert_tweets(df, db_path))
+        record("get_cutoffs", lambda: get_cutoffs(db_path))
+        record("rebuild_cutoffs", lambda: rebuild_cutoffs(db_path))
+        record("load_tweets", lambda: load_tweets(db_path))
+        record("load_month", lambda: load_month(df["month"].iloc[0], db_path))
+        record("df_to_csv", lambda: df_to_csv(df, csv_path))
+        record("csv_to_df", lambda: csv_to_df(csv_path))
+
+        monthly_input = df.drop(columns=["month", "parsed_time"])
+        del df
+        record("monthly pipeline", lambda: monthly_transform(monthly_input))
+
+    return results
+
+
+def bench_quote_fetch(n_tweets=20, quotes_per_tweet=250, latency=0.05) -> list:
+    """Times fetching quotes of {n_tweets} tweets from the mock API, serially vs. in parallel."""
+    corpus = mock_twitter_api.synthetic_corpus(n_mentions=0, n_tweets=n_tweets, quotes_per_tweet=quotes_per_tweet)
+    n_quotes = sum(len(q) for q in corpus["quotes"].values())
+    results = []
+
+    with scratch_dir():
+        for workers in sorted({1, quote_workers}):
+            mock_twitter_api.install(mock_twitter_api.MockTwitterAPI(corpus, latency=latency))
+            try:
+                seconds, _ = run_stage(lambda: get_new_quote_tweets(
+                    mock_twitter_api.default_user_id, "", max_workers=workers), memory=False)
+            finally:
+                reset_session()
+            results.append({"stage": f"get_new_quote_tweets (workers={workers})", "rows": n_quotes,
+                "seconds": round(seconds, 3), "peak_mb": None})
+
+    return results
+
+
+def check_rate_limits(paths=(rate_limit_recording,), n_tweets=30, rate_limit=12) -> list:
+    """
+    Replays recorded headers of all {paths} & fetches quotes of {n_tweets} tweets from
+    a mock API allowing {rate_limit} requests per window. Returns one result per check,
+    "rate_limited" counts requests the limiter let through into a used up window.
+    """
+    results = []
+    for path in paths:
+        replayed = replay_headers(load_history(path))
+        results.append({"check": f"replay {os.path.basename(path)}", "requests": replayed["requests"],
+            "rate_limited": replayed["would_be_rate_limited"], "slept_s": round(replayed["slept"], 1),
+            "simulated_s": round(replayed["elapsed"], 1)})
+
+    clock = SimulatedClock(start=time.time())
+    started = clock.now
+    corpus = mock_twitter_api.synthetic_corpus(n_mentions=0, n_tweets=n_tweets, quotes_per_tweet=5)
+    api = mock_twitter_api.MockTwitterAPI(corpus, latency=0.5, rate_limit=rate_limit,
+        clock=clock.time, sleep=clock.sleep)
+    limiter, live_limiter = RateLimiter(clock=clock.time, sleep=clock.sleep), query_and_filter.RATE_LIMITER
+
+    with scratch_dir(), redirect_stdout(io.StringIO()):
+        mock_twitter_api.install(api)
+        query_and_filter.RATE_LIMITER = limiter
+        try:
+            get_new_quote_tweets(mock_twitter_api.default_user_id, "", max_workers=quote_workers)
+        finally:
+            query_and_filter.RATE_LIMITER = live_limiter
+            reset_session()
+
+    counts = [c for endpoint in api.counts.values() for c in endpoint.items()]
+    results.append({"check": f"mock api (workers={quote_workers})", "requests": sum(n for _, n in counts),
+        "rate_limited": sum(n for status, n in counts if status == 429), "slept_s": round(limiter.slept, 1),
+        "simulated_s": round(clock.now - started, 1)})
+    return results
+
+
+def load_baseline(path=baseline_path) -> dict:
+    """Returns {(stage, rows): result} of a saved baseline, empty if there's none."""
+    if not exists(path):
+        return {}
+    with open(path) as f:
+        saved = json.load(f)
+    return {(r["stage"], r["rows"]): r for r in saved["results"]}
+
+
+def save_baseline(results, path=baseline_path) -> None:
+    """Saves results as baseline. Stages & sizes not in {results} are kept from the old baseline."""
+    merged = load_baseline(path)
+    merged.update({(r["stage"], r["rows"]): r for r in results})
+    saved = {
+        "saved_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "results": list(merged.values()),
+    }
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=1)
+
+
+def compare(results, baseline) -> list:
+    """Adds baseline values, change & regressions ("time", "memory") to each result."""
+    for r in results:
+        b = baseline.get((r["stage"], r["rows"]))
+        r["baseline_s"] = b["seconds"] if b else None
+        r["change"] = f"{r['seconds'] / b['seconds'] - 1:+.0%}" if b and b["seconds"] else None
+        regressed = []
+
+        if b and r["seconds"] > b["seconds"] * (1 + tolerance) and r["seconds"] - b["seconds"] >= min_regression_s:
+            regressed.append("time")
+        if b and r["peak_mb"] is not None and b["peak_mb"] is not None and \
+            r["peak_mb"] > b["peak_mb"] * (1 + tolerance) and r["peak_mb"] - b["peak_mb"] >= min_regression_mb:
+            regressed.append("memory")
+        r["regressed"] = ", ".join(regressed)
+
+    return results
+
+
+def run_suite(sizes=suite_sizes, path=baseline_path, save=False, memory=True) -> list:
+    """Runs the suite for all {sizes}, prints results vs. baseline. Returns results."""
+    baseline = load_baseline(path)
+    results = []
+
+    for n in sizes:
+        print(f"Running stages on {n} synthetic tweets...")
+        results.extend(bench_suite(n, memory))
+    print("Fetching quotes from the mock API...")
+    results.extend(bench_quote_fetch())
+
+    print()
+    print(pd.DataFrame(compare(results, baseline)).to_string(index=False))
+
+    if save:
+        save_baseline(results, path)
+        print("\nBaseline saved to", path)
+    return results
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["suite"]:
+    parser = argparse.ArgumentParser(description="Benchmark all pipeline stages against a baseline.")
+    parser.add_argument("suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=suite_sizes)
+    parser.add_argument("--baseline", default=baseline_path)
+    parser.add_argument("--save-baseline", action="store_true", help="Save results as new baseline.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracing memory (halves run time).")
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.baseline, args.save_baseline, not args.no_memory)
+    if any(r["regressed"] for r in results) and not args.save_baseline:
+        sys.exit(1)
+
+elif __name__ == "__main__" and sys.argv[1:2] == ["rate_limits"]:
+    results = check_rate_limits(sys.argv[2:] or [rate_limit_recording])
+    print(pd.DataFrame(results).to_string(index=False))
+    if any(r["rate_limited"] for r in results):
+        print("\nRate limiter let through requests the API would answer with 429.")
+        sys.exit(1)
+
+elif __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else n_rows
+    print(f"Scoring {n} synthetic tweets (outputs identical):\n")
+    print(pd.DataFrame(bench_scoring(n)).to_string(index=False))
+    print(f"\nBuilding DataFrame from {n} synthetic tweets (outputs identical):\n")
+    print(pd.DataFrame(bench_normalize(n)).to_string(index=False))
+    print(f"\nHolding {n} tweets parsed from API responses (DataFrames identical):\n")
+    print(pd.DataFrame(bench_records(n)).to_string(index=False))
+    print(f"\nParsing & archiving {n} tweets per json library (archive identical):\n")
+    print(pd.DataFrame(bench_json(n)).to_string(index=False))
+    n_csv = int(sys.argv[1]) if len(sys.argv) > 1 else csv_rows
+    print(f"\nWriting csv database of {n_csv} rows (files identical):\n")
+    print(pd.DataFrame(bench_csv_write(n_csv)).to_string(index=False))
+    print(f"\nLoading csv database of {n_csv} rows (outputs identical):\n")
+    print(pd.DataFrame(bench_csv_load(n_csv)).to_string(index=False))
@@ -0,0 +1,258 @@
+"""
+Pool of long-lived headless Chrome sessions used for scraping the Twitter
+frontend. All browsers sign in through the ChromeUserData profile created by
+Selenium_Twitter_Login.py. Since Chrome locks a profile while it's in use, the
+2nd, 3rd, ... browser each work on their own copy of it. Settings in .env:
+
+    SCRAPE_WORKERS=2                         browsers running at the same time
+    SCRAPE_HEADLESS=1                        set to 0 to watch the browsers
+    SCRAPE_BASE_URL=https://twitter.com      point to a stub server for testing
+
+If executed directly, scrapes the saved pages in {fixture_dir} from a local stub
+server & compares the tagged users with the expected ones. --static skips the
+browsers & only checks the stub server & parser (no Chrome needed):
+
+    python browser_pool.py check [--static]
+"""
+
+import os
+import sys
+import queue
+import atexit
+import shutil
+import argparse
+import tempfile
+import threading
+import functools
+import requests
+from os.path import exists, join, dirname, abspath
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from bs4 import BeautifulSoup
+from dotenv import load_dotenv
+load_dotenv('./.env')
+
+profile_dir = "ChromeUserData"
+scrape_workers = max(1, int(os.environ.get("SCRAPE_WORKERS", 2)))
+headless = os.environ.get("SCRAPE_HEADLESS", "1") != "0"
+base_url = os.environ.get("SCRAPE_BASE_URL", "https://twitter.com").rstrip("/")
+debugging_port = 9222
+
+# Longest time to wait for the media tags modal to list the tagged users
+page_timeout = 80
+tagged_user_class = "css-1rynq56 r-dnmrzs r-1udh08x r-3s2u2q r-bcqeeo r-qvutc0 r-37j5jr " + \
+    "r-a023e6 r-rjixqe r-16dba41 r-18u37iz r-1wvb978"
+
+# The tweet's action bar is a div[role="group"] as well, so wait for the users inside the modal
+modal_selector = 'div[role="dialog"]'
+tagged_user_selector = modal_selector + " div." + ".".join(tagged_user_class.split())
+
+# Saved media tags pages {tweet id}.html & the users they list (None: scrape must fail)
+fixture_dir = join(dirname(abspath(__file__)), "scrape_fixtures")
+fixture_tags = {
+    "1000000000000000001": ["alice", "bob"],
+    "1000000000000000002": ["carol"],
+    "1000000000000000003": None,
+}
+
+BROWSER_POOL = None
+
+
+def media_tags_url(tweet_dict, base_url=base_url) -> str:
+    return f"{base_url}/{tweet_dict['username']}/status/{tweet_dict['id']}/media_tags"
+
+
+def parse_tagged_users(html) -> list:
+    """
+    Parses the usernames listed in the media tags modal of a tweet page. Raises ValueError
+    if the page has no modal listing users, so an unfinished page never reads as "no tags".
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    modal = soup.find("div", {"role": "dialog"})
+    users = [] if modal is None else modal.find_all("div", {"class": tagged_user_class})
+    if users == []:
+        raise ValueError("No tagged users found in media tags modal.")
+    return [x.text.replace('@', '') for x in users]
+
+
+class BrowserPool:
+    """
+    Starts up to {size} browsers on demand & hands out idle ones to fetch().
+    Browsers that crash are replaced. Call close() when done.
+    """
+
+    def __init__(self, size=scrape_workers, profile_dir=profile_dir, headless=headless):
+        self.size = size
+        self.profile_dir = profile_dir
+        self.headless = headless
+        self._idle = queue.Queue()
+        self._slots = queue.Queue()
+        self._drivers = {}
+        self._lock = threading.Lock()
+
+        # Each slot number maps to one profile directory & debugging port
+        for n in range(size):
+            self._slots.put(n)
+
+    def _profile(self, n) -> str:
+        """Profile for the {n}th browser. Copies the signed-in profile if needed."""
+        if n == 0:
+            return self.profile_dir
+
+        copy_dir = f"{self.profile_dir}_{n}"
+        if not exists(copy_dir) and exists(self.profile_dir):
+            shutil.copytree(
+                self.profile_dir,
+                copy_dir,
+                ignore=shutil.ignore_patterns("Singleton*", "*.lock", "Crashpad"),
+            )
+        return copy_dir
+
+    def _start(self, n) -> webdriver.Chrome:
+        options = Options()
+        options.add_argument(f"--user-data-dir={self._profile(n)}")
+        options.add_argument(f"--remote-debugging-port={debugging_port + n}")
+        if self.headless:
+            options.add_argument("--headless=new")
+        options.page_load_strategy = 'normal'
+        return webdriver.Chrome(options=options)
+
+    def _acquire(self) -> webdriver.Chrome:
+        """Returns an idle browser. Starts a new one if a slot is free, else waits."""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                n = self._slots.get_nowait()
+            except queue.Empty:
+                try:
+                    return self._idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+            try:
+                driver = self._start(n)
+            except Exception:
+                self._slots.put(n)
+                raise
+
+            with self._lock:
+                self._drivers[driver] = n
+            return driver
+
+    def _discard(self, driver) -> None:
+        with self._lock:
+            n = self._drivers.pop(driver, None)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        if n is not None:
+            self._slots.put(n)
+
+    def fetch(self, url, wait_for=tagged_user_selector, timeout=page_timeout) -> str:
+        """
+        Loads {url} in an idle browser & waits until {wait_for} (css selector)
+        is present. Returns the page source. Raises TimeoutException if it never shows up.
+        """
+        driver = self._acquire()
+        try:
+            driver.get(url)
+            WebDriverWait(driver, timeout).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, wait_for))
+            )
+            html = driver.page_source
+
+        except TimeoutException:
+            self._idle.put(driver)
+            raise
+
+        except Exception:
+            self._discard(driver)
+            raise
+
+        self._idle.put(driver)
+        return html
+
+    def close(self) -> None:
+        with self._lock:
+            drivers = list(self._drivers)
+        for driver in drivers:
+            self._discard(driver)
+        self._idle = queue.Queue()
+
+
+def get_browser_pool() -> BrowserPool:
+    """Returns the module-wide pool, creating it on first use."""
+    global BROWSER_POOL
+    if BROWSER_POOL is None:
+        BROWSER_POOL = BrowserPool()
+        atexit.register(BROWSER_POOL.close)
+    return BROWSER_POOL
+
+
+def serve_fixtures(directory=fixture_dir, host="127.0.0.1", port=0) -> ThreadingHTTPServer:
+    """
+    Returns a local http server answering /<username>/status/<id>/media_tags with
+    {directory}/<id>.html (port 0: any free port). Call serve_forever() on it.
+    """
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            parts = path.split("?")[0].strip("/").split("/")
+            name = f"{parts[2]}.html" if len(parts) == 4 and parts[1:4:2] == ["status", "media_tags"] else ""
+            return join(directory, name)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), functools.partial(Handler, directory=directory))
+
+
+def check_fixtures(static=False, timeout=10) -> list:
+    """
+    Scrapes all pages of {fixture_tags} from a stub server, with a temporary browser pool
+    (or plain requests if {static}). Returns list of (tweet id, expected, scraped) per page.
+    """
+    server = serve_fixtures()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://{server.server_address[0]}:{server.server_address[1]}"
+    pool = None if static else BrowserPool(size=1, profile_dir=join(tempfile.mkdtemp(), "profile"))
+    results = []
+
+    try:
+        for tweet_id, expected in fixture_tags.items():
+            url = media_tags_url({"id": tweet_id, "username": "fixture"}, base_url=stub_url)
+            try:
+                html = requests.get(url).text if static else pool.fetch(url, timeout=timeout)
+                scraped = parse_tagged_users(html)
+            except (TimeoutException, ValueError):
+                scraped = None
+            results.append((tweet_id, expected, scraped))
+    finally:
+        if pool is not None:
+            pool.close()
+        server.shutdown()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the scraper against saved media tags pages.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    check_cmd = commands.add_parser("check", help="Scrape the pages in scrape_fixtures/ from a stub server.")
+    check_cmd.add_argument("--static", action="store_true", help="Parse the served html without a browser.")
+    args = parser.parse_args()
+
+    results = check_fixtures(static=args.static)
+    for tweet_id, expected, scraped in results:
+        print(f"{tweet_id}: expected {expected}, scraped {scraped}", "" if scraped == expected else "<- MISMATCH")
+    if any(scraped != expected for _, expected, scraped in results):
+        sys.exit(1)
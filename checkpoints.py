@@ -0,0 +1,181 @@
+"""
+Checkpoints for paginated queries. While paging through results, the next
+pagination token & the id range fetched so far are saved per endpoint & query
+parameters, next to a spool file holding the pages already fetched. If a query
+is cut short (rate limit, crash), the next run with the same parameters replays
+the spooled pages & continues at the saved token instead of querying again.
+
+If executed directly, lists or removes unfinished checkpoints:
+
+    python checkpoints.py list
+    python checkpoints.py clear
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from os.path import exists, join
+from helpers import json_dumps, json_loads
+
+checkpoint_dir = "./pagination_checkpoints"
+
+# Pagination tokens don't stay valid forever. Older checkpoints are dropped.
+max_age = 7*24*60*60
+
+# Keys of the checkpoints opened by this process, i.e. of the queries of the current run
+opened = set()
+
+
+def checkpoint_key(url, params) -> str:
+    """Identifies a query by its url & parameters (except the pagination token)."""
+    query = {k: v for k, v in params.items() if k != "pagination_token"}
+    raw = json.dumps([url, query], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+class Checkpoint:
+    """
+    Progress of one paginated query. Each fetched page is appended to the spool
+    before the checkpoint is updated, so the spool never lags behind it.
+    """
+
+    def __init__(self, url, params, directory=checkpoint_dir, clock=time.time):
+        self.url = url
+        self.params = {k: v for k, v in params.items() if k != "pagination_token"}
+        self.clock = clock
+        key = checkpoint_key(url, params)
+        opened.add(key)
+        self.key = key
+        self.path = join(directory, f"{key}.json")
+        self.spool_path = join(directory, f"{key}.jsonl")
+        self.directory = directory
+        self.state = None
+
+    def load(self) -> dict:
+        """Returns the saved state, None if there's none or it expired."""
+        if not exists(self.path):
+            return None
+
+        with open(self.path) as f:
+            state = json.load(f)
+
+        if self.clock() - state["updated_at"] > max_age:
+            print(f"Dropping expired checkpoint of {self.url}.")
+            self.clear()
+            return None
+
+        # Drop spooled pages written after the checkpoint was last saved (crash in between)
+        pages = list(self._read_spool(state["pages"]))
+        if len(pages) < state["pages"]:
+            print(f"Spool of {self.url} is incomplete. Starting over.")
+            self.clear()
+            return None
+        with open(self.spool_path, "wb") as f:
+            f.writelines(json_dumps(p) + b"\n" for p in pages)
+
+        self.state = state
+        return state
+
+    def _read_spool(self, n_pages):
+        if not exists(self.spool_path):
+            return
+        with open(self.spool_path, "rb") as f:
+            for _, line in zip(range(n_pages), f):
+                yield json_loads(line)
+
+    def replay(self):
+        """Yields the tweets of each spooled page, oldest page first."""
+        if self.state is not None:
+            yield from self._read_spool(self.state["pages"])
+
+    def save_page(self, tweets, next_token) -> None:
+        """Spools a fetched page & records the token of the page after it."""
+        os.makedirs(self.directory, exist_ok=True)
+        state = self.state or {
+            "url": self.url,
+            "params": self.params,
+            "pages": 0,
+            "tweets": 0,
+            "newest_id": None,
+            "oldest_id": None,
+            "started_at": self.clock(),
+        }
+
+        with open(self.spool_path, "ab" if state["pages"] > 0 else "wb") as f:
+            f.write(json_dumps(tweets) + b"\n")
+
+        ids = [int(t["id"]) for t in tweets]
+        if state["newest_id"] is not None:
+            ids += [int(state["newest_id"]), int(state["oldest_id"])]
+
+        state.update({
+            "next_token": next_token,
+            "pages": state["pages"] + 1,
+            "tweets": state["tweets"] + len(tweets),
+            "newest_id": str(max(ids)) if ids != [] else None,
+            "oldest_id": str(min(ids)) if ids != [] else None,
+            "updated_at": self.clock(),
+        })
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self.state = state
+
+    def clear(self) -> None:
+        """Removes checkpoint & spool, e.g. once the last page has been fetched."""
+        for path in (self.path, self.spool_path):
+            if exists(path):
+                os.remove(path)
+        self.state = None
+
+
+def pending(directory=checkpoint_dir, keys=None) -> list:
+    """
+    Returns the states of all unfinished checkpoints that haven't expired. If {keys} is
+    given, only those of these queries (e.g. {opened} for the queries of this run).
+    """
+    if not exists(directory):
+        return []
+
+    states = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        if keys is not None and name[:-len(".json")] not in keys:
+            continue
+        with open(join(directory, name)) as f:
+            state = json.load(f)
+        if time.time() - state["updated_at"] <= max_age:
+            states.append(state)
+    return states
+
+
+def clear_all(directory=checkpoint_dir) -> int:
+    """Removes all checkpoints. Returns number of removed checkpoints."""
+    if not exists(directory):
+        return 0
+
+    names = os.listdir(directory)
+    for name in names:
+        os.remove(join(directory, name))
+    return sum(1 for name in names if name.endswith(".json"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage checkpoints of unfinished paginated queries.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Show unfinished queries.")
+    commands.add_parser("clear", help="Forget all unfinished queries.")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for s in pending():
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(s["updated_at"]))
+            print(f"{s['url']}\t{s['pages']} pages\t{s['tweets']} tweets\t" + \
+                f"ids {s['oldest_id']} - {s['newest_id']}\tupdated {updated}")
+    elif args.command == "clear":
+        print(f"Removed {clear_all()} checkpoints.")
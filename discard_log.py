@@ -0,0 +1,193 @@
+"""
+Append-only log of all tweets dropped by the filters, stored in SQLite. Each
+tweet is recorded once per reason (the name of the regex filter or "not
+mentioning JediSwap"), so recording a run's rejections costs O(rejections)
+instead of rewriting the whole history.
+
+If executed directly, shows why tweets were dropped, compacts the log, exports
+the tweets dropped for one reason to csv or imports the old csv files:
+
+    python discard_log.py why <tweet id> [<tweet id> ...]
+    python discard_log.py compact [--older-than <days>]
+    python discard_log.py export <reason> [<csv path>]
+    python discard_log.py import <csv path> [<csv path> ...]
+"""
+
+import time
+import sqlite3
+import argparse
+import pandas as pd
+from os.path import basename
+from helpers import csv_to_df, df_to_csv
+
+log_path = "./discarded_tweets.sqlite"
+
+# Reason recorded by discount_mentions()
+not_mentioning_reason = "not_mentioning_jediswap"
+
+# Tweet attributes kept per entry
+logged_fields = ["text", "comment", "created_at", "username", "author_id", "source"]
+
+schema = """
+CREATE TABLE IF NOT EXISTS discarded (
+    reason TEXT NOT NULL,
+    tweet_id TEXT NOT NULL,
+    text TEXT,
+    comment TEXT,
+    created_at TEXT,
+    username TEXT,
+    author_id TEXT,
+    source TEXT,
+    logged_at REAL NOT NULL,
+    PRIMARY KEY (reason, tweet_id)
+);
+CREATE INDEX IF NOT EXISTS discarded_tweet_id ON discarded (tweet_id);
+"""
+
+
+def connect(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    return conn
+
+
+def legacy_reason(csv_path) -> str:
+    """Reason of a csv file written by older versions, e.g. "spam" for discarded_tweets_spam.csv."""
+    name = basename(csv_path).rsplit(".", 1)[0]
+    if name.startswith("discarded_tweets_"):
+        return name[len("discarded_tweets_"):]
+    return name
+
+
+class DiscardLog:
+    """
+    Dropped tweets keyed by (reason, tweet id). Tweets logged again for the same
+    reason are ignored, the first entry is kept.
+    """
+
+    def __init__(self, path=log_path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = connect(self.path)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, tweets, reason) -> int:
+        """Logs {tweets} as dropped for {reason}. Returns number of new entries."""
+        now = self.clock()
+        rows = [
+            (reason, str(t["id"])) +
+            tuple(None if t.get(k) is None else str(t[k]) for k in logged_fields) +
+            (now,)
+            for t in tweets
+        ]
+        if rows == []:
+            return 0
+
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO discarded VALUES ({', '.join('?'*len(rows[0]))})", rows
+            )
+            return self.conn.total_changes - before
+
+    def why(self, tweet_id) -> list:
+        """Returns all entries of {tweet_id} as dictionaries, oldest first. Empty if it was never dropped."""
+        cursor = self.conn.execute(
+            "SELECT * FROM discarded WHERE tweet_id = ? ORDER BY logged_at", (str(tweet_id),)
+        )
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def load(self, reason=None) -> pd.DataFrame:
+        """All entries (of one {reason} if given), ordered by tweet id."""
+        query = "SELECT * FROM discarded"
+        params = ()
+        if reason is not None:
+            query += " WHERE reason = ?"
+            params = (reason,)
+        return pd.read_sql_query(query + " ORDER BY CAST(tweet_id AS INTEGER)", self.conn, params=params)
+
+    def counts(self) -> dict:
+        """Returns {reason: number of logged tweets}."""
+        return dict(self.conn.execute("SELECT reason, COUNT(*) FROM discarded GROUP BY reason"))
+
+    def compact(self, older_than=None) -> int:
+        """
+        Removes entries logged more than {older_than} seconds ago (none if None) &
+        rebuilds the database file to reclaim space. Returns number of removed entries.
+        """
+        n_removed = 0
+        if older_than is not None:
+            with self.conn:
+                cursor = self.conn.execute(
+                    "DELETE FROM discarded WHERE logged_at < ?", (self.clock() - older_than,)
+                )
+            n_removed = cursor.rowcount
+
+        self.conn.execute("VACUUM")
+        return n_removed
+
+    def import_csv(self, csv_path, reason=None) -> int:
+        """Adds all tweets from a discard csv written by older versions. Returns number of new entries."""
+        df = csv_to_df(csv_path)
+        df = df.astype(object).where(df.notna(), None)
+        return self.add(df.to_dict("records"), reason or legacy_reason(csv_path))
+
+    def export_csv(self, reason, csv_path) -> int:
+        """Writes all tweets dropped for {reason} to {csv_path}. Returns number of rows."""
+        df = self.load(reason).drop(columns=["reason", "logged_at"]).rename(columns={"tweet_id": "id"})
+        df_to_csv(df, csv_path)
+        return df.shape[0]
+
+
+DISCARD_LOG = DiscardLog()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect & maintain the log of dropped tweets.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    why = commands.add_parser("why", help="Show why tweets were dropped.")
+    why.add_argument("tweet_ids", nargs="+")
+    compact = commands.add_parser("compact", help="Prune old entries & shrink the log file.")
+    compact.add_argument("--older-than", type=float, help="Remove entries older than this many days.")
+    export = commands.add_parser("export", help="Export tweets dropped for one reason to csv.")
+    export.add_argument("reason")
+    export.add_argument("csv_path", nargs="?")
+    _import = commands.add_parser("import", help="Add tweets from discard csv files of older versions.")
+    _import.add_argument("csv_paths", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "why":
+        for tweet_id in args.tweet_ids:
+            entries = DISCARD_LOG.why(tweet_id)
+            if entries == []:
+                print(f"{tweet_id}\tnot dropped")
+            for e in entries:
+                logged_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["logged_at"]))
+                print(f"{tweet_id}\t{e['reason']}\t{logged_at}\t{e['comment'] or ''}")
+    elif args.command == "compact":
+        older_than = None if args.older_than is None else args.older_than * 24*60*60
+        n_removed = DISCARD_LOG.compact(older_than)
+        print(f"Removed {n_removed} entries. Remaining:", DISCARD_LOG.counts())
+    elif args.command == "export":
+        csv_path = args.csv_path or (
+            f"./{args.reason}.csv" if args.reason == not_mentioning_reason
+            else f"./discarded_tweets_{args.reason}.csv"
+        )
+        n_rows = DISCARD_LOG.export_csv(args.reason, csv_path)
+        print(f"Exported {n_rows} tweets to", csv_path.lstrip("./"))
+    elif args.command == "import":
+        for csv_path in args.csv_paths:
+            n_new = DISCARD_LOG.import_csv(csv_path)
+            print(f"Imported {n_new} new entries from", csv_path.lstrip("./"))
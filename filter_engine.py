@@ -0,0 +1,147 @@
+"""
+Compiled regex filter engine. All filters are compiled once & each tweet is
+classified in a single pass, recording the first filter (in list order) that
+matches its text.
+
+Checking every filter against every tweet gets linearly slower with each rule
+added. Instead, each filter is indexed by a literal string any of its matches
+must contain (e.g. "giveaway" for r"\\bgiveaway\\b"). A single trie-shaped
+regex finds all indexed literals in a text, so only filters whose literal
+occurs (plus the few without a usable literal) are actually run.
+"""
+
+import re
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+# Flags allowed in filter dictionaries
+regex_flags = {"multiline": re.M, "dotall": re.S, "verbose": re.X, "ignorecase": re.I, "uni_code": re.U}
+
+
+def required_literal(pattern, flags=0) -> str:
+    """Longest string each match of {pattern} has to contain. Empty string if there's none."""
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, RecursionError):
+        return ""
+
+    best, run = "", ""
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run += chr(av)
+        elif op is sre_constants.AT:
+            # Zero-width, e.g. \b or ^. Literals on both sides stay adjacent.
+            continue
+        else:
+            best, run = max(best, run, key=len), ""
+
+    return max(best, run, key=len)
+
+
+def fold(text) -> str:
+    """
+    Key under which re.IGNORECASE considers {text} equal to other strings: "ſ" & "s" or "K"
+    (Kelvin) & "k" share a key, unlike with str.lower(). Empty string if folding changes the
+    length (e.g. "İ", "ß"), since such literals can't be found with the same length in a text.
+    """
+    key = "".join(ch.upper().lower() for ch in text)  # char by char: lower() of "Σ" depends on context
+    return key if len(key) == len(text) else ""
+
+
+def trie_pattern(words) -> str:
+    """
+    Regex matching any of {words}, shaped as a trie so its cost doesn't grow with
+    the number of words. Matches the longest word starting at a given position.
+    """
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def to_regex(node) -> str:
+        branches = [re.escape(ch) + to_regex(child) for ch, child in sorted(node.items()) if ch != ""]
+        if branches == []:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return to_regex(trie)
+
+
+class FilterEngine:
+    """
+    Takes a list of filter dictionaries {"name", "pattern", "flag"}. classify()
+    returns the name of the first filter matching a text, or None.
+    """
+
+    def __init__(self, filters):
+        self.rules = []
+        self.unindexed = []
+        by_literal = {}
+
+        for i, f in enumerate(filters):
+            flags = regex_flags.get(f["flag"], 0)
+            self.rules.append((f["name"], re.compile(f["pattern"], flags)))
+            literal = fold(required_literal(f["pattern"], flags))
+            if literal != "":
+                by_literal.setdefault(literal, []).append(i)
+            else:
+                self.unindexed.append(i)
+
+        # Case-insensitive, so literals of both kinds of filters are found. Filters still decide.
+        self.finder = None
+        if by_literal != {}:
+            self.finder = re.compile(f"(?=({trie_pattern(by_literal)}))", re.I)
+
+        # Finder only reports the longest literal per position -> add filters of its prefixes
+        self.candidates = {}
+        for literal in by_literal:
+            idx = []
+            for j in range(1, len(literal) + 1):
+                idx.extend(by_literal.get(literal[:j], []))
+            self.candidates[literal] = idx
+
+    def classify(self, text):
+        """Returns name of the first filter matching {text}, None if no filter matches."""
+        to_check = set(self.unindexed)
+
+        if self.finder is not None:
+            for found in self.finder.findall(text):
+                idx = self.candidates.get(fold(found))
+
+                # Case folding differs between re & str methods for a few characters
+                if idx is None:
+                    to_check = range(len(self.rules))
+                    break
+                to_check.update(idx)
+
+        for i in sorted(to_check):
+            name, rule = self.rules[i]
+            if rule.search(text):
+                return name
+
+        return None
+
+
+def classify_tweets(tweets, filters) -> tuple:
+    """
+    Single pass over {tweets}. Returns tuple (kept_tweets, discarded) where {discarded}
+    is a dictionary {filter name: [tweets]}. Each tweet is assigned to the first filter
+    (in list order) whose pattern matches in tweet["text"].
+    """
+    engine = FilterEngine(filters)
+    kept = []
+    discarded = {f["name"]: [] for f in filters}
+
+    for t in tweets:
+        name = engine.classify(t["text"])
+        if name is None:
+            kept.append(t)
+        else:
+            discarded[name].append(t)
+
+    return (kept, discarded)
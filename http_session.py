@@ -0,0 +1,104 @@
+"""
+Shared, connection-pooled HTTP session used for all Twitter API requests.
+Keeps TCP/TLS connections alive between paginated calls instead of opening
+a new connection per request. Pool size & retries can be set in .env:
+
+    HTTP_POOL_SIZE=10
+    HTTP_MAX_RETRIES=3
+"""
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+load_dotenv('./.env')
+
+pool_size = int(os.environ.get("HTTP_POOL_SIZE", 10))
+max_retries = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+backoff_factor = 1
+
+# Transient errors retried by the adapter. 429 is left to the caller.
+retry_on_status = (500, 502, 503, 504)
+
+SESSION = None
+_session_lock = threading.Lock()
+
+
+def build_session(pool_size=pool_size, max_retries=max_retries) -> requests.Session:
+    """Returns a new requests.Session with a pooled, retrying https adapter."""
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=retry_on_status,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """Returns the module-wide session, creating it on first use (also from worker threads)."""
+    global SESSION
+    if SESSION is None:
+        with _session_lock:
+            if SESSION is None:
+                SESSION = build_session()
+    return SESSION
+
+
+def reset_session(session=None) -> None:
+    """Closes the current session. Replaces it with {session} if given."""
+    global SESSION
+    with _session_lock:
+        if SESSION is not None:
+            SESSION.close()
+        SESSION = session
+
+
+def get_connection_stats(session=None):
+    """
+    Counts requests sent & new connections opened by all pools of {session}.
+    Every request not needing a new connection reused a kept-alive one.
+    Returns None if the session has no connection pools (e.g. mock_twitter_api.py).
+    """
+    session = session or SESSION
+    if session is None:
+        return None
+
+    stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+    pooled = False
+    for adapter in set(session.adapters.values()):
+        pools = getattr(adapter, "poolmanager", None)
+        if pools is None:
+            continue
+        pooled = True
+        for key in pools.pools.keys():
+            pool = pools.pools[key]
+            stats["requests"] += pool.num_requests
+            stats["new_connections"] += pool.num_connections
+
+    if not pooled:
+        return None
+    stats["reused_connections"] = stats["requests"] - stats["new_connections"]
+    return stats
+
+    for adapter in set(session.adapters.values()):
+        pools = getattr(adapter, "poolmanager", None)
+        if pools is None:
+            continue
+        for key in pools.pools.keys():
+            pool = pools.pools[key]
+            stats["requests"] += pool.num_requests
+            stats["new_connections"] += pool.num_connections
+
+    stats["reused_connections"] = stats["requests"] - stats["new_connections"]
+    return stats
@@ -0,0 +1,171 @@
+"""
+Per-run instrumentation. Records every API request (endpoint, status code, bytes,
+latency, tweets returned), time slept on rate limits & time spent per pipeline
+stage. At the end of a run, write_report() saves a machine-readable summary to
+{report_dir}, one json file per run, to track API usage & regressions over time.
+
+Stages are timed with the stage() context manager or the timed() decorator.
+Stages can be nested & run in several threads at once, so their times may add
+up to more than the run took.
+"""
+
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from rate_limiter import endpoint_key
+
+report_dir = "./run_reports"
+
+# Upper bounds (seconds) of the latency histogram buckets
+latency_buckets = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+
+def percentile(sorted_values, q) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if sorted_values == []:
+        return None
+    rank = max(1, round(q / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(latencies) -> dict:
+    values = sorted(latencies)
+    histogram = {f"<={b}s": 0 for b in latency_buckets}
+    histogram[f">{latency_buckets[-1]}s"] = 0
+
+    for v in values:
+        for b in latency_buckets:
+            if v <= b:
+                histogram[f"<={b}s"] += 1
+                break
+        else:
+            histogram[f">{latency_buckets[-1]}s"] += 1
+
+    return {
+        "total_s": round(sum(values), 3),
+        "mean_s": round(sum(values) / len(values), 3) if values else None,
+        "p50_s": percentile(values, 50),
+        "p90_s": percentile(values, 90),
+        "p99_s": percentile(values, 99),
+        "max_s": values[-1] if values else None,
+        "histogram": histogram,
+    }
+
+
+class RunStats:
+    """Thread-safe collector of request & stage measurements for one run."""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started_at = time.time()
+        self._start = clock()
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.stages = {}
+
+    def _endpoint(self, url) -> dict:
+        key = endpoint_key(url)
+        if key not in self.endpoints:
+            self.endpoints[key] = {
+                "requests": 0,
+                "status_codes": {},
+                "tweets": 0,
+                "bytes": 0,
+                "latencies": [],
+                "rate_limit_sleep_s": 0.0,
+            }
+        return self.endpoints[key]
+
+    def record_request(self, url, status_code, n_bytes, seconds, n_tweets=0) -> None:
+        with self._lock:
+            e = self._endpoint(url)
+            e["requests"] += 1
+            e["status_codes"][str(status_code)] = e["status_codes"].get(str(status_code), 0) + 1
+            e["tweets"] += n_tweets
+            e["bytes"] += n_bytes
+            e["latencies"].append(round(seconds, 4))
+
+    def n_requests(self) -> int:
+        """Number of responses received so far, over all endpoints."""
+        with self._lock:
+            return sum(e["requests"] for e in self.endpoints.values())
+
+    def record_sleep(self, url, seconds) -> None:
+        """Counts time spent waiting for a rate limit of {url}'s endpoint."""
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._endpoint(url)["rate_limit_sleep_s"] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as pipeline stage {name}."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            seconds = self.clock() - start
+            with self._lock:
+                s = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+                s["calls"] += 1
+                s["seconds"] += seconds
+
+    def timed(self, name=None):
+        """Decorator timing each call of a function as stage {name} (default: function name)."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self, extra=None) -> dict:
+        """Returns all measurements as a json-serializable dictionary. Adds {extra} on top level."""
+        with self._lock:
+            endpoints = {}
+            for key, e in sorted(self.endpoints.items()):
+                endpoints[key] = {k: v for k, v in e.items() if k != "latencies"}
+                endpoints[key]["rate_limit_sleep_s"] = round(e["rate_limit_sleep_s"], 3)
+                endpoints[key]["latency"] = latency_summary(e["latencies"])
+
+            stages = {
+                name: {"calls": s["calls"], "seconds": round(s["seconds"], 3)}
+                for name, s in self.stages.items()
+            }
+
+        totals = {
+            "requests": sum(e["requests"] for e in endpoints.values()),
+            "tweets": sum(e["tweets"] for e in endpoints.values()),
+            "bytes": sum(e["bytes"] for e in endpoints.values()),
+            "rate_limit_sleep_s": round(sum(e["rate_limit_sleep_s"] for e in endpoints.values()), 3),
+        }
+
+        report = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "duration_s": round(self.clock() - self._start, 3),
+            "totals": totals,
+            "endpoints": endpoints,
+            "stages": stages,
+        }
+        report.update(extra or {})
+        return report
+
+    def write_report(self, path=None, extra=None) -> str:
+        """Saves report() as json to {path} (default: a timestamped file in {report_dir}). Returns path."""
+        if path is None:
+            os.makedirs(report_dir, exist_ok=True)
+            stamp = time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime(self.started_at))
+            path = os.path.join(report_dir, f"run_{stamp}.json")
+
+        with open(path, "w") as f:
+            json.dump(self.report(extra), f, indent=1, default=str)
+        return path
+
+
+RUN_STATS = RunStats()
+stage = RUN_STATS.stage
+timed = RUN_STATS.timed
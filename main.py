@@ -14,33 +14,32 @@ Written by Al Matty - github.com/al-matty
 
 from sys import exit
 from os.path import exists
-from query_and_filter import discount_mentions, get_filtered_tweets, get_cutoffs
-from helpers import csv_to_df, df_to_csv
+from query_and_filter import discount_mentions, get_filtered_tweets, stream_filtered_tweets, get_cutoffs
+from http_session import get_connection_stats
+from storage import upsert_tweets, import_csv, compute_cutoffs, save_cutoffs
+from checkpoints import pending, opened
+from instrumentation import RUN_STATS, timed
+from rate_limiter import RATE_LIMITER
+from tweet_cache import TWEET_CACHE
 from pandas_pipes import *
 
-out_path = "./Force_Wielders_Data_beta.csv"
-first_run = not exists(out_path)
+out_path = "./Force_Wielders_Data_beta.sqlite"
+legacy_csv_path = "./Force_Wielders_Data_beta.csv"   # database format before sqlite
+first_run = not (exists(out_path) or exists(legacy_csv_path))
 add_params = None
 
+# Save tweets page by page while querying (for large backfills via {add_params}).
+# Memory use stays bounded by the page size & an interrupted run keeps saved pages.
+stream = False
 
-def run(add_params=add_params):
 
-    # Get most recent known tweets from dataset if it exists
-    query_until_ids = None if (first_run or add_params) else get_cutoffs(out_path)
-
-    # Fetch new tweets since last execution.
-    new_tweets = get_filtered_tweets(cutoff_ids=query_until_ids, add_params=add_params)
-    if new_tweets == {}:
-        print("No new mentions or quote tweets since last execution.")
-        exit(0)
-
-    # Drop reply tweets & discount mentions inherited from elsewhere in the conversation
-    new_tweets = discount_mentions(new_tweets)
-
-    # Create DataFrame & perform all needed transformations of the data
-    in_df = pd.DataFrame.from_dict(new_tweets, orient="index")
+@timed("pandas_pipeline")
+def transform(tweets_dict) -> pd.DataFrame:
+    """Creates DataFrame & performs all needed transformations of the data."""
+    in_df = tweets_to_df(tweets_dict)
 
     out_df = (in_df.pipe(start_pipeline)
+        .pipe(add_missing_columns, optional_columns)
         .pipe(replace_nans)
         .pipe(add_parsed_time)
         .pipe(extract_public_metrics)
@@ -48,27 +47,104 @@ def run(add_params=add_params):
         .pipe(drop_columns, to_drop)
         .pipe(reorder_columns, final_order)
     )
+    return out_df
+
+
+def cutoffs_final() -> bool:
+    """
+    False if a paginated query of this run stopped early. Its checkpoint is resumed next run
+    with the same query parameters, so cutoff ids must stay where they are until then.
+    Checkpoints of other queries (e.g. an interrupted backfill via {add_params}) don't count.
+    """
+    unfinished = pending(keys=opened)
+    if unfinished != []:
+        print(f"{len(unfinished)} queries unfinished (see checkpoints.py). Keeping cutoff ids until resumed.")
+    return unfinished == []
+
+
+def save_stream(query_until_ids, add_params) -> int:
+    """
+    Saves filtered tweets page by page as they are queried. Cutoff watermarks are only
+    moved forward once all pages are saved, so an interrupted run is queried again
+    (without duplicates) next time. Returns number of newly added tweets.
+    """
+    n_rows = 0
+    cutoff_d = {}
+
+    for new_tweets in stream_filtered_tweets(cutoff_ids=query_until_ids, add_params=add_params):
+        out_df = transform(new_tweets)
+        n_rows += upsert_tweets(out_df, out_path, update_cutoffs=False)
+        print(f"Saved {out_df.shape[0]} tweets ({n_rows} new so far).")
+
+        for k, v in compute_cutoffs(out_df).items():
+            cutoff_d[k] = max(cutoff_d.get(k, v), v, key=int)
+
+    if cutoffs_final():
+        save_cutoffs(cutoff_d, out_path)
+    return n_rows
+
 
-    # Merge with database / keep only latest fetched version per tweet
-    if exists(out_path):
+def write_run_report(n_rows) -> None:
+    """
+    Saves requests, bytes, latencies, rate limit waits & stage times of this run as json.
+    Includes the received rate limit headers if recorded (see rate_limiter.py).
+    """
+    from query_and_filter import N_TWEETS_QUERIED
+    extra = {
+        "tweets_queried": N_TWEETS_QUERIED,
+        "tweets_added": n_rows,
+        "connections": get_connection_stats(),
+        "tweet_cache": TWEET_CACHE.stats(),
+        "rate_limit_sleep_total_s": round(RATE_LIMITER.slept, 3),
+    }
+    if RATE_LIMITER.history is not None:
+        extra["rate_limit_history"] = RATE_LIMITER.history
+    path = RUN_STATS.write_report(extra=extra)
+    print("Run report saved to", path.lstrip("./"))
+
+
+def run(add_params=add_params, stream=stream):
+
+    # Move tweets from the old csv database into the sqlite database once
+    if not exists(out_path) and exists(legacy_csv_path):
+        n_rows = import_csv(legacy_csv_path, out_path)
+        print(f"Imported {n_rows} tweets from", legacy_csv_path.lstrip("./"), "\n")
+
+    # Get most recent known tweets from dataset if it exists
+    query_until_ids = None if (first_run or add_params) else get_cutoffs(out_path)
+
+    # Fetch, transform & save new tweets page by page
+    if stream:
+        n_rows = save_stream(query_until_ids, add_params)
 
-        known_data = csv_to_df(out_path)
-        out_df = pd.concat([known_data, out_df]) \
-            .sort_values("impression_count") \
-            .drop_duplicates("id", keep="last") \
-            .sort_values("id")
-        known_len = known_data.shape[0]
-    
     else:
-        known_len = 0
-        
-    # Save updated database & preserve type information in 2nd row
-    df_to_csv(out_df, out_path, mode="w", sep=",")
-    n_rows = out_df.shape[0] - known_len
+        # Fetch new tweets since last execution.
+        new_tweets = get_filtered_tweets(cutoff_ids=query_until_ids, add_params=add_params)
+        if new_tweets == {}:
+            print("No new mentions or quote tweets since last execution.")
+            write_run_report(n_rows=0)
+            exit(0)
+
+        # Drop reply tweets & discount mentions inherited from elsewhere in the conversation
+        new_tweets = discount_mentions(new_tweets)
+
+        # Create DataFrame & perform all needed transformations of the data
+        out_df = transform(new_tweets)
+
+        # Upsert into database / keep only the version with most impressions per tweet
+        n_rows = upsert_tweets(out_df, out_path, update_cutoffs=cutoffs_final())
+
     print(f"Appended {n_rows} tweets to", out_path.lstrip("./"), "\n")
     from query_and_filter import N_TWEETS_QUERIED
-    print(f"\nQueried {N_TWEETS_QUERIED} tweets in total.\n")
+    print(f"\nQueried {N_TWEETS_QUERIED} tweets in total.")
+    conn = get_connection_stats()
+    if conn is None:
+        print(f"Sent {RUN_STATS.n_requests()} requests (no connection pool stats for this transport).\n")
+    else:
+        print(f"Sent {RUN_STATS.n_requests()} requests over {conn['new_connections']} connections " + \
+            f"({conn['reused_connections']} reused).\n")
+    write_run_report(n_rows)
 
 
 if __name__ == "__main__":
-    run(add_params)
\ No newline at end of file
+    run(add_params, stream)
\ No newline at end of file
@@ -0,0 +1,499 @@
+"""
+Offline stand-in for the Twitter API v2 endpoints queried by this repo:
+
+    GET /2/users/:id/mentions
+    GET /2/users/:id/tweets
+    GET /2/tweets/:id/quote_tweets
+    GET /2/tweets?ids=...
+
+Serves a synthetic corpus (synthetic_corpus()) or one rebuilt from the archive
+or json backups written by earlier runs (corpus_from_backups()). Latency, rate limit
+headers & injected 429 responses are configurable, so throughput & pacing can
+be benchmarked reproducibly without network access or a bearer token.
+
+In-process, mount it as transport adapter on the shared session:
+
+    api = MockTwitterAPI(synthetic_corpus(), latency=0.05, rate_limit=75)
+    install(api)
+
+Or run it as local server & set TWITTER_API_BASE_URL=http://127.0.0.1:8000 in .env:
+
+    python mock_twitter_api.py [--port 8000] [--latency 0.05] [--rate-limit 75] [--backups <archive or json> ...]
+"""
+
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from helpers import read_list_from_json
+from archive import iter_archived_tweets
+from http_session import reset_session
+from rate_limiter import endpoint_key
+from tweet_cache import user_metrics, user_fields, derived_fields
+
+default_user_id = "1470315931142393857"
+default_username = "JediSwap"
+
+# Tweet ids encode their creation time (ms since this epoch, shifted by 22 bits)
+twitter_epoch_ms = 1288834974657
+
+# Limits of max_results per page
+min_page_size = 5
+max_page_size = 100
+lookup_limit = 100
+
+
+def id_from_time(dt, seq=0) -> str:
+    ms = int(dt.timestamp() * 1000) - twitter_epoch_ms
+    return str((ms << 22) + seq)
+
+
+def time_from_id(tweet_id) -> datetime:
+    ms = (int(tweet_id) >> 22) + twitter_epoch_ms
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def format_time(dt) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def parse_time(s) -> datetime:
+    return datetime.fromisoformat(s.replace("Z", "+00:00"))
+
+
+def empty_corpus() -> dict:
+    return {"users": {}, "tweets": {}, "mentions": {}, "timelines": {}, "quotes": {}}
+
+
+def synthetic_corpus(n_mentions=1000, n_tweets=20, quotes_per_tweet=10, n_users=200,
+    user_id=default_user_id, username=default_username, seed=0) -> dict:
+    """
+    Random corpus of tweets around account {user_id}: {n_mentions} mentions (plain
+    mentions, replies inheriting the mention, replies to the account, long note tweets),
+    {n_tweets} tweets by the account & {quotes_per_tweet} quote tweets of each.
+    """
+    rnd = random.Random(seed)
+    corpus = empty_corpus()
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+    def add_user(_id, name):
+        corpus["users"][_id] = {
+            "id": _id,
+            "username": name,
+            "public_metrics": {m: rnd.randint(0, 5000) for m in user_metrics},
+        }
+
+    add_user(user_id, username)
+    user_ids = [str(10**9 + i) for i in range(n_users)]
+    for i, _id in enumerate(user_ids):
+        add_user(_id, f"user{i}")
+
+    def add_tweet(dt, author_id, text, mentions=(), **fields):
+        _id = id_from_time(dt, seq=len(corpus["tweets"]) % 4096)
+        tweet = {
+            "id": _id,
+            "edit_history_tweet_ids": [_id],
+            "text": text,
+            "created_at": format_time(dt),
+            "author_id": author_id,
+            "conversation_id": _id,
+            "public_metrics": {
+                "retweet_count": rnd.randint(0, 5),
+                "reply_count": rnd.randint(0, 5),
+                "like_count": rnd.randint(0, 50),
+                "quote_count": rnd.randint(0, 3),
+                "impression_count": rnd.randint(0, 20_000),
+            },
+        }
+        if mentions:
+            tweet["entities"] = {"mentions": [
+                {"start": 0, "end": len(m) + 1, "username": m, "id": next(
+                    (u["id"] for u in corpus["users"].values() if u["username"] == m), "0")}
+                for m in mentions
+            ]}
+        tweet.update(fields)
+        corpus["tweets"][_id] = tweet
+        return tweet
+
+    # Events spread evenly over time, so ids grow with creation time
+    n_events = n_tweets * (1 + quotes_per_tweet) + n_mentions
+    step = timedelta(seconds=max(1, 365*24*60*60 // max(n_events, 1)))
+    dt = start
+    own_tweets, mentions = [], []
+    quotes = {}
+
+    kinds = ["own"] * n_tweets + ["mention"] * n_mentions
+    rnd.shuffle(kinds)
+    pending_quotes = []
+
+    for kind in kinds:
+        dt += step
+
+        # Quotes of earlier tweets by the account trickle in between other tweets
+        while pending_quotes and rnd.random() < 0.5:
+            quoted = pending_quotes.pop(0)
+            author = rnd.choice(user_ids)
+            t = add_tweet(dt, author, f"Look at this {quoted['id'][-4:]}",
+                referenced_tweets=[{"type": "quoted", "id": quoted["id"]}])
+            quotes.setdefault(quoted["id"], []).append(t["id"])
+            dt += step
+
+        if kind == "own":
+            t = add_tweet(dt, user_id, f"gm from {username} #{len(own_tweets)}")
+            own_tweets.append(t)
+            pending_quotes.extend([t] * quotes_per_tweet)
+            continue
+
+        author = rnd.choice(user_ids)
+        author_name = corpus["users"][author]["username"]
+        r = rnd.random()
+
+        # Reply inheriting the mention from its parent
+        if r < 0.25 and mentions:
+            parent = rnd.choice(mentions)
+            parent_name = corpus["users"][parent["author_id"]]["username"]
+            t = add_tweet(dt, author, f"@{parent_name} @{username} agreed", [parent_name, username],
+                referenced_tweets=[{"type": "replied_to", "id": parent["id"]}],
+                in_reply_to_user_id=parent["author_id"], conversation_id=parent["conversation_id"])
+
+        # Reply to a tweet by the account
+        elif r < 0.35 and own_tweets:
+            parent = rnd.choice(own_tweets)
+            t = add_tweet(dt, author, f"@{username} wen token", [username],
+                referenced_tweets=[{"type": "replied_to", "id": parent["id"]}],
+                in_reply_to_user_id=user_id, conversation_id=parent["id"])
+
+        # Long tweet, text truncated unless note_tweet is read
+        elif r < 0.40:
+            long_text = f"@{username} " + "swapping all day " * 20 + f"- {author_name}"
+            t = add_tweet(dt, author, long_text[:270] + "…", [username],
+                note_tweet={"text": long_text, "entities": {"mentions": [{"username": username}]}})
+
+        else:
+            others = rnd.sample(user_ids, rnd.randint(0, 3))
+            names = [corpus["users"][o]["username"] for o in others]
+            t = add_tweet(dt, author, " ".join(f"@{n}" for n in [username] + names) + " gm", [username] + names)
+
+        mentions.append(t)
+
+    # Remaining quotes after the last event
+    for quoted in pending_quotes:
+        dt += step
+        t = add_tweet(dt, rnd.choice(user_ids), f"Look at this {quoted['id'][-4:]}",
+            referenced_tweets=[{"type": "quoted", "id": quoted["id"]}])
+        quotes.setdefault(quoted["id"], []).append(t["id"])
+
+    # Timelines are newest first, like the API
+    corpus["mentions"][user_id] = [t["id"] for t in reversed(mentions)]
+    corpus["timelines"][user_id] = [t["id"] for t in reversed(own_tweets)]
+    corpus["quotes"] = {k: list(reversed(v)) for k, v in quotes.items()}
+    return corpus
+
+
+def corpus_from_tweets(tweets, user_id=default_user_id, username=default_username) -> dict:
+    """
+    Rebuilds a corpus from tweets as returned by the query functions (user data merged
+    into each tweet, "source" attribute set). Quoted tweets of the account that aren't
+    among {tweets} are added as stubs.
+    """
+    corpus = empty_corpus()
+    corpus["users"][user_id] = {"id": user_id, "username": username,
+        "public_metrics": {m: 0 for m in user_metrics}}
+    mentions, timeline, quotes = set(), set(), {}
+    skip = set(user_fields + derived_fields)
+
+    for t in tweets:
+        corpus["users"].setdefault(t["author_id"], {
+            "id": t["author_id"],
+            "username": t["username"],
+            "public_metrics": {m: t.get(m, 0) for m in user_metrics},
+        })
+        corpus["tweets"][t["id"]] = {k: v for k, v in t.items() if k not in skip}
+
+        source = t.get("source")
+        if source == "get_new_mentions()":
+            mentions.add(t["id"])
+        elif source == "get_new_tweets_by_user()":
+            timeline.add(t["id"])
+        elif source == "get_quotes_for_tweet()":
+            for ref in t.get("referenced_tweets", []):
+                if ref["type"] == "quoted":
+                    quotes.setdefault(ref["id"], set()).add(t["id"])
+                    timeline.add(ref["id"])
+
+    for _id in timeline:
+        corpus["tweets"].setdefault(_id, {
+            "id": _id,
+            "edit_history_tweet_ids": [_id],
+            "text": "",
+            "created_at": format_time(time_from_id(_id)),
+            "author_id": user_id,
+            "conversation_id": _id,
+            "public_metrics": {"retweet_count": 0, "reply_count": 0, "like_count": 0,
+                "quote_count": 0, "impression_count": 0},
+        })
+
+    newest_first = lambda ids: sorted(ids, key=int, reverse=True)
+    corpus["mentions"][user_id] = newest_first(mentions)
+    corpus["timelines"][user_id] = newest_first(timeline)
+    corpus["quotes"] = {k: newest_first(v) for k, v in quotes.items()}
+    return corpus
+
+
+def corpus_from_backups(json_paths, user_id=default_user_id, username=default_username) -> dict:
+    """
+    Corpus from the archive files (see archive.py) or "<date range> unfiltered <function>.json"
+    backups of earlier runs.
+    """
+    tweets = []
+    for path in json_paths:
+        if path.endswith(".json"):
+            tweets.extend(read_list_from_json(path))
+        else:
+            tweets.extend(iter_archived_tweets([path]))
+    return corpus_from_tweets(tweets, user_id, username)
+
+
+class MockTwitterAPI:
+    """
+    Answers API requests from {corpus}. Each endpoint allows {rate_limit} requests per
+    {window} seconds (unlimited if None) & reports its budget in x-rate-limit-* headers.
+    Requests wait {latency} seconds (or uniformly between a (min, max) tuple). 429
+    responses can be injected with probability {fail_rate} or for given request
+    numbers {fail_requests} (counting from 1). They report a reset {retry_after}
+    seconds later, also without {rate_limit}. Pass the same SimulatedClock as
+    {clock} & {sleep} here & to the RateLimiter to skip waiting altogether.
+    """
+
+    def __init__(self, corpus, latency=0.0, rate_limit=None, window=15*60, fail_rate=0.0,
+        fail_requests=(), retry_after=1, seed=0, clock=time.time, sleep=time.sleep):
+        self.corpus = corpus
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.fail_rate = fail_rate
+        self.fail_requests = set(fail_requests)
+        self.retry_after = retry_after
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = random.Random(seed)
+        self.n_requests = 0
+        self.counts = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _wait(self) -> None:
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._lock:
+                latency = self.rng.uniform(*latency)
+        if latency > 0:
+            self.sleep(latency)
+
+    def _rate_limit(self, key) -> tuple:
+        """Takes one request from {key}'s budget. Returns tuple (allowed, headers)."""
+        with self._lock:
+            self.n_requests += 1
+            injected = self.n_requests in self.fail_requests or \
+                (self.fail_rate > 0 and self.rng.random() < self.fail_rate)
+
+            # Injected 429s stand for short bursts, the budget of the window is left untouched
+            now = self.clock()
+            retry_reset = str(math.ceil(now + self.retry_after))
+
+            if self.rate_limit is None:
+                return (False, {"x-rate-limit-reset": retry_reset}) if injected else (True, {})
+
+            start, used = self._windows.get(key, (now, 0))
+            if now >= start + self.window:
+                start, used = now, 0
+
+            exhausted = used >= self.rate_limit
+            if not exhausted and not injected:
+                used += 1
+            self._windows[key] = (start, used)
+
+            headers = {
+                "x-rate-limit-limit": str(self.rate_limit),
+                "x-rate-limit-remaining": str(0 if exhausted or injected else self.rate_limit - used),
+                "x-rate-limit-reset": str(int(start + self.window)),
+            }
+            if injected and not exhausted:
+                headers["x-rate-limit-reset"] = retry_reset
+            return (not exhausted and not injected, headers)
+
+    def handle(self, method, url) -> tuple:
+        """Returns tuple (status_code, headers, body bytes) for a request."""
+        parts = urlsplit(url)
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        path = parts.path.rstrip("/").split("/")
+        key = endpoint_key(url)
+
+        self._wait()
+        allowed, headers = self._rate_limit(key)
+        headers["content-type"] = "application/json; charset=utf-8"
+
+        if method != "GET":
+            status, body = 405, {"title": "Method Not Allowed"}
+        elif not allowed:
+            status, body = 429, {"title": "Too Many Requests", "detail": "Too Many Requests", "type": "about:blank", "status": 429}
+        elif path[1:] == ["2", "tweets"] and "ids" in params:
+            status, body = 200, self.lookup(params["ids"].split(","))
+        elif len(path) == 5 and path[1:3] == ["2", "users"] and path[4] == "mentions":
+            status, body = 200, self.page(self.corpus["mentions"].get(path[3], []), params)
+        elif len(path) == 5 and path[1:3] == ["2", "users"] and path[4] == "tweets":
+            status, body = 200, self.page(self.corpus["timelines"].get(path[3], []), params)
+        elif len(path) == 5 and path[1:3] == ["2", "tweets"] and path[4] == "quote_tweets":
+            status, body = 200, self.page(self.corpus["quotes"].get(path[3], []), params)
+        else:
+            status, body = 404, {"title": "Not Found Error", "detail": f"No route for {parts.path}"}
+
+        with self._lock:
+            counts = self.counts.setdefault(key, {})
+            counts[status] = counts.get(status, 0) + 1
+
+        return (status, headers, json.dumps(body).encode())
+
+    def _with_users(self, tweets) -> dict:
+        authors = dict.fromkeys(t["author_id"] for t in tweets)
+        users = [self.corpus["users"][a] for a in authors if a in self.corpus["users"]]
+        return {"data": tweets, "includes": {"users": users}}
+
+    def page(self, ids, params) -> dict:
+        """One page of the tweets {ids} (newest first) matching the query {params}."""
+        since_id = int(params.get("since_id", 0))
+        until_id = int(params["until_id"]) if "until_id" in params else None
+        start_time = parse_time(params["start_time"]) if "start_time" in params else None
+        end_time = parse_time(params["end_time"]) if "end_time" in params else None
+
+        def matches(_id) -> bool:
+            if int(_id) <= since_id or (until_id is not None and int(_id) >= until_id):
+                return False
+            if start_time or end_time:
+                created = parse_time(self.corpus["tweets"][_id]["created_at"])
+                if (start_time and created < start_time) or (end_time and created >= end_time):
+                    return False
+            return True
+
+        ids = [_id for _id in ids if matches(_id)]
+        size = min(max(int(params.get("max_results", 10)), min_page_size), max_page_size)
+        offset = int(params.get("pagination_token", "0"), 16)
+        chunk = ids[offset:offset+size]
+
+        meta = {"result_count": len(chunk)}
+        if chunk == []:
+            return {"meta": meta}
+
+        meta["newest_id"], meta["oldest_id"] = chunk[0], chunk[-1]
+        if offset + size < len(ids):
+            meta["next_token"] = f"{offset + size:x}"
+
+        out = self._with_users([self.corpus["tweets"][_id] for _id in chunk])
+        out["meta"] = meta
+        return out
+
+    def lookup(self, ids) -> dict:
+        """Tweets by id. Unknown ids are reported in "errors" like deleted tweets."""
+        ids = ids[:lookup_limit]
+        found = [self.corpus["tweets"][_id] for _id in ids if _id in self.corpus["tweets"]]
+        errors = [{
+            "value": _id,
+            "detail": f"Could not find tweet with ids: [{_id}].",
+            "title": "Not Found Error",
+            "resource_type": "tweet",
+            "parameter": "ids",
+            "resource_id": _id,
+            "type": "https://api.twitter.com/2/problems/resource-not-found",
+        } for _id in ids if _id not in self.corpus["tweets"]]
+
+        out = self._with_users(found) if found != [] else {}
+        if errors != []:
+            out["errors"] = errors
+        return out
+
+
+class MockAdapter(BaseAdapter):
+    """requests transport adapter answering all requests from a MockTwitterAPI."""
+
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        status, headers, body = self.api.handle(request.method, request.url)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def install(api) -> requests.Session:
+    """Replaces the shared session with one whose requests are all answered by {api}."""
+    session = requests.Session()
+    adapter = MockAdapter(api)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    reset_session(session)
+    return session
+
+
+def serve(api, host="127.0.0.1", port=8000) -> ThreadingHTTPServer:
+    """Returns a local http server answering requests from {api}. Call serve_forever() on it."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, headers, body = api.handle("GET", f"http://{host}:{port}{self.path}")
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock of the Twitter API locally.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--backups", nargs="*", help="Serve tweets from archive files or json backups instead of synthetic ones.")
+    parser.add_argument("--mentions", type=int, default=1000, help="Synthetic mentions.")
+    parser.add_argument("--tweets", type=int, default=20, help="Synthetic tweets by the account.")
+    parser.add_argument("--quotes", type=int, default=10, help="Synthetic quotes per tweet.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request.")
+    parser.add_argument("--rate-limit", type=int, help="Requests per endpoint & window.")
+    parser.add_argument("--window", type=float, default=15*60, help="Rate limit window in seconds.")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered with 429.")
+    parser.add_argument("--retry-after", type=float, default=1, help="Seconds until injected 429s reset.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.backups:
+        corpus = corpus_from_backups(args.backups)
+    else:
+        corpus = synthetic_corpus(args.mentions, args.tweets, args.quotes, seed=args.seed)
+
+    api = MockTwitterAPI(corpus, latency=args.latency, rate_limit=args.rate_limit,
+        window=args.window, fail_rate=args.fail_rate, retry_after=args.retry_after, seed=args.seed)
+    server = serve(api, port=args.port)
+    print(f"Serving {len(corpus['tweets'])} tweets on http://127.0.0.1:{args.port}")
+    print(f"Set TWITTER_API_BASE_URL=http://127.0.0.1:{args.port} & TWITTER_USER_ID={default_user_id}")
+    server.serve_forever()
@@ -3,9 +3,12 @@ All pandas-related functions are defined here.
 """
 
 import re
+import numpy as np
 import pandas as pd
 import datetime as dt
+from records import TweetRecord, records_to_columns
 
+public_metrics = ["impression_count", "reply_count", "retweet_count", "like_count", "quote_count"]
 to_rename = {"username": "user", "discounted_mentions": "mentions"}
 to_drop = ["edit_history_tweet_ids", "public_metrics"]
 final_order = [
@@ -32,14 +35,90 @@ final_order = [
     "referenced_tweets",
 ]
 
+# Columns replaced when refreshing the metrics of stored tweets
+metric_columns = public_metrics + ["username", "followers_count", "following_count", "tweet_count", "listed_count"]
+
+# API fields only present if a tweet has them. Kept as columns even if no tweet in a batch has them.
+optional_columns = ["in_reply_to_user_id", "referenced_tweets"]
+
+
+def tweets_to_df(tweets) -> pd.DataFrame:
+    """
+    Builds a DataFrame from a dictionary {id: tweet} or a list of tweets (dicts or
+    TweetRecords) in a single pass. Nested public_metrics are flattened into typed int
+    columns on the way, so extract_public_metrics() has nothing left to do.
+    Missing fields become None (replaced by replace_nans like NaN would be).
+    """
+    if isinstance(tweets, dict):
+        index = list(tweets.keys())
+        tweets = list(tweets.values())
+    else:
+        index = None
+
+    # Records are transposed column by column from their value lists
+    if tweets != [] and all(isinstance(t, TweetRecord) for t in tweets):
+        columns, metrics = records_to_columns(tweets, public_metrics)
+        if metrics is not None:
+            columns.update(metrics)
+        return pd.DataFrame(columns, index=index)
+
+    n = len(tweets)
+    columns = {}
+    metrics = {m: np.zeros(n, dtype="int64") for m in public_metrics}
+    n_with_metrics = 0
+
+    for i, t in enumerate(tweets):
+        for k, v in t.items():
+            if k == "public_metrics":
+                for m in public_metrics:
+                    metrics[m][i] = v[m]
+                n_with_metrics += 1
+                continue
+            if k not in columns:
+                columns[k] = [None] * n
+            columns[k][i] = v
+
+    # Keep the nested column if some tweets lack metrics, like pd.DataFrame.from_dict would
+    if n_with_metrics == n:
+        columns.update(metrics)
+    elif n_with_metrics > 0:
+        columns["public_metrics"] = [t.get("public_metrics") for t in tweets]
+
+    return pd.DataFrame(columns, index=index)
 
 def start_pipeline(df) -> pd.DataFrame:
     """Copy df for inplace operations to work as expected."""
     return df.copy()
 
+def add_missing_columns(df, columns) -> pd.DataFrame:
+    """Adds any column in {columns} not present in data as object column of None (False after replace_nans())."""
+    for c in columns:
+        if c not in df.columns:
+            df[c] = pd.Series(None, index=df.index, dtype=object)
+    return df
+
+def join_metrics(df, metrics_df) -> pd.DataFrame:
+    """
+    Replaces the {metric_columns} of stored tweets with the ones in {metrics_df}, keeps
+    all other columns as stored. Tweets missing from {metrics_df} (deleted, suspended) are dropped.
+    """
+    if metrics_df.shape[0] == 0:
+        return df.iloc[0:0]
+
+    refreshed = [c for c in metric_columns if c in metrics_df.columns]
+    kept = df.drop(columns=[c for c in refreshed if c in df.columns])
+    return kept.merge(metrics_df[["id"] + refreshed], on="id", how="inner")
+
 def replace_nans(df) -> pd.DataFrame:
-    """Replace any nan with False (bool)."""
+    """
+    Replace any nan with False (bool). Object columns stay object columns, even if only
+    False is left (fillna would downcast them to bool, which the database would keep).
+    """
+    objects = [c for c in df.columns if df[c].dtype == object]
     df.fillna(value=False, inplace=True)
+    for c in objects:
+        if df[c].dtype != object:
+            df[c] = df[c].astype(object)
     return df
 
 def rename_columns(df, old_new_dict) -> pd.DataFrame:
@@ -69,8 +148,16 @@ def add_prefix(df, target_col, prefix_str) -> pd.DataFrame:
     df[target_col] = prefix_str + df[target_col].astype(str)
     return df
 
+def month_key(times) -> pd.Series:
+    """Year-month keys ("2023-12") of a datetime column. Each distinct month is formatted once."""
+    year_month = times.dt.year.values * 100 + times.dt.month.values
+    months, inverse = np.unique(year_month, return_inverse=True)
+    keys = np.array([f"{m // 100}-{m % 100:02d}" for m in months], dtype=object)
+    return pd.Series(keys[inverse], index=times.index, dtype=object)
+
 def add_month(df) -> pd.DataFrame:
-    df['month'] = df['parsed_time'].dt.month_name()
+    """Adds the month a tweet counts for as "YYYY-MM", so the same month of different years doesn't collide."""
+    df['month'] = month_key(df['parsed_time'])
     return df
 
 def keep_five_per_author(df) -> pd.DataFrame:
@@ -83,13 +170,25 @@ def keep_five_per_author(df) -> pd.DataFrame:
 
     return df
 
+def points_formula(n_views) -> int:
+    points = int((n_views**(1/1.6))*0.45)
+    return points
+
 def assign_points(df) -> pd.DataFrame:
-    
-    def points_formula(n_views):
-        points = int((n_views**(1/1.6))*0.45)
-        return points
-    
-    df["points"] = df["impression_count"].apply(points_formula)
+
+    # Vectorized points_formula(). Truncates like int()
+    views = df["impression_count"]
+    raw = (views ** (1/1.6)) * 0.45
+    points = raw.astype("int64")
+
+    # numpy's pow may differ from python's in the last bit. Where that could
+    # flip the truncation to the next integer, use the python formula instead.
+    frac = raw - np.floor(raw)
+    edge = (frac < 1e-9) | (frac > 1 - 1e-9)
+    if edge.any():
+        points[edge] = [points_formula(n) for n in views[edge].tolist()]
+
+    df["points"] = points
     
     # 0 points if followers <11 or impressions <50
     df.loc[df["followers_count"] < 11, "points"] = 0
@@ -98,51 +197,50 @@ def assign_points(df) -> pd.DataFrame:
     # 0 points if > 8 mentions
     df.loc[df["n mentions"] > 8, "points"] = 0
     
-    # Divide by n mentions if > 3 mentions in tweet
-    def adjust_points(row):  
-        if int(row["n mentions"]) > 3:
-           return int(row["points"] / row["n mentions"])
-        else:
-            return int(row["points"])
-    
-    df["points"] = df.apply(adjust_points, axis=1)
+    # Divide by n mentions if > 3 mentions in tweet (truncated like int())
+    n_mentions = df["n mentions"]
+    divide = n_mentions > 3
+    divided = (df["points"] / n_mentions.where(divide, 1)).astype("int64")
+    df["points"] = divided.where(divide, df["points"]).astype("int64")
 
     return df
 
 def add_followers_per_retweets(df) -> pd.DataFrame:
-    
-    def f(row):  
-        if int(row["retweet_count"]) + int(row["quote_count"]) == 0:
-            return "never retweeted or quoted"
-        else:
-            return int(row["followers_count"] / (row["retweet_count"] + row["quote_count"]))
-    
-    df['followers_per_retweets'] = df.apply(f, axis=1)
-    
+
+    shares = df["retweet_count"] + df["quote_count"]
+    never_shared = shares == 0
+    ratio = (df["followers_count"] / shares.where(~never_shared, 1)).astype("int64")
+
+    # Column holds text for tweets never retweeted or quoted
+    if never_shared.any():
+        ratio = ratio.astype(object)
+        ratio[never_shared] = "never retweeted or quoted"
+
+    df['followers_per_retweets'] = ratio
+
     return df
 
+def count_mentions(df) -> np.ndarray:
+    """Lengths of all mention lists, counted in C (faster than .str.len() on lists)."""
+    mentions = df["discounted_mentions"].values
+    return np.fromiter(map(len, mentions), dtype="int64", count=len(mentions))
+
 def add_more_than_5_mentions_flag(df) -> pd.DataFrame:
-    
-    def set_flag(mentions_list):
-        return True if len(mentions_list) > 5 else False
 
-    df[">5 mentions"] = df["discounted_mentions"].apply(set_flag)
-    
+    df[">5 mentions"] = count_mentions(df) > 5
+
     return df
 
 def add_truncated_text_flag(df) -> pd.DataFrame:
-    
-    def set_flag(tweet_text):
-        return True if tweet_text.find("…") != -1 else False
 
-    df["truncated_text"] = df["text"].apply(set_flag)
-    
+    df["truncated_text"] = np.array(["…" in text for text in df["text"].values], dtype=bool)
+
     return df
 
 def add_n_mentions(df) -> pd.DataFrame:
 
-    df["n mentions"] = df["discounted_mentions"].apply(lambda mentions: len(mentions))
-    
+    df["n mentions"] = count_mentions(df)
+
     return df
 
 def apply_and_concat(dataframe, field, func, column_names) -> pd.DataFrame:
@@ -157,17 +255,15 @@ def apply_and_concat(dataframe, field, func, column_names) -> pd.DataFrame:
             lambda cell: pd.Series(func(cell), index=column_names))), axis=1)
 
 def extract_public_metrics(df) -> pd.DataFrame:
-    """Adds specific dictionary entries as new columns."""
-    def extract_from_dict(dict_field) -> tuple:
-        d = dict_field
-        return (
-            d["impression_count"],
-            d["reply_count"],
-            d["retweet_count"],
-            d["like_count"],
-            d["quote_count"]
-        )
-    new_cols = ["impression_count", "reply_count", "retweet_count", "like_count", "quote_count"]
-    df = apply_and_concat(df, 'public_metrics', extract_from_dict, new_cols)
+    """
+    Adds specific dictionary entries as new columns. Builds each column straight
+    from the list of dicts. Does nothing if tweets_to_df() flattened them already.
+    """
+    if "public_metrics" not in df.columns:
+        return df
+
+    metrics = df["public_metrics"].tolist()
+    for m in public_metrics:
+        df[m] = np.fromiter((d[m] for d in metrics), dtype="int64", count=len(metrics))
     return df
 
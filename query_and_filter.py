@@ -21,24 +21,35 @@ parameters can be passed using {add_params}. Examples:
 
 import os
 import inspect
-import requests
-import re
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from bs4 import BeautifulSoup
-from ast import literal_eval
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
-from pprint import pp, pformat
-from copy import deepcopy
-from time import sleep
+from time import perf_counter
 from dotenv import load_dotenv
 from helpers import *
+from http_session import get_session
+from rate_limiter import RATE_LIMITER
+from tweet_cache import TWEET_CACHE, MEDIA_TAGS
+from browser_pool import get_browser_pool, media_tags_url, parse_tagged_users
+from storage import read_cutoffs
+from filter_engine import classify_tweets
+from discard_log import DISCARD_LOG, not_mentioning_reason
+from checkpoints import Checkpoint
+from records import TweetRecord, as_records, paused_gc
+from archive import append_page
+from instrumentation import RUN_STATS, timed
 load_dotenv('./.env')
 
 target_user_id = os.environ.get("TWITTER_USER_ID")
 bearer_token = os.environ.get("API_BEARER_TOKEN")
+api_base_url = os.environ.get("TWITTER_API_BASE_URL", "https://api.twitter.com").rstrip("/")  # mock_twitter_api.py for offline runs
 N_TWEETS_QUERIED = 0
-MEDIA_TWEETS = {}        # used as temporary storage for scraping media tags from a tweet on Twitter
+quote_workers = max(1, int(os.environ.get("QUOTE_WORKERS", 4)))  # tweets queried for quotes in parallel
+lookup_workers = max(1, int(os.environ.get("LOOKUP_WORKERS", 4)))  # 100-id lookups kept in flight at once
+lookup_retries = 2  # retries per failed 100-id lookup
+max_rate_limit_waits = 3  # 429 responses tolerated per request before giving up
+offline = False  # set by replay.py: lookups & media tags are only served from the local stores
+_counter_lock = threading.Lock()
 
 # Any filtered-out tweets go here for checking if filters work correctly
 discarded_path = "./discarded_tweets.json"
@@ -82,10 +93,38 @@ def get_query_params() -> dict:
     return params
 
 
+# Fields needed to refresh metrics of known tweets (id, text & username are always returned)
+metrics_params = {
+    "tweet.fields": "author_id,public_metrics",
+    "user.fields": "public_metrics",
+    "expansions": "author_id",
+}
+
+
 def connect_to_endpoint(url, params, bearer_token) -> tuple:
-    """Wrapper for Twitter API queries. Returns response & status code."""
-    response = requests.request("GET", url, auth=bearer_oauth, params=params)
-    print(response.status_code)
+    """
+    Wrapper for Twitter API queries. Returns response & status code.
+    Requests are paced by RATE_LIMITER. On 429, waits until the rate limit
+    reset reported by the API & retries (at most {max_rate_limit_waits} times).
+    Each request & any time spent waiting is recorded in RUN_STATS.
+    """
+    for attempt in range(max_rate_limit_waits + 1):
+        RUN_STATS.record_sleep(url, RATE_LIMITER.acquire(url))
+        start = perf_counter()
+        response = get_session().get(url, auth=bearer_oauth, params=params)
+        latency = perf_counter() - start
+        RATE_LIMITER.update(url, response.status_code, response.headers)
+
+        try:
+            json_response = json_loads(response.content)
+        except (ValueError, JSONDecodeError):
+            json_response = None
+        RUN_STATS.record_request(url, response.status_code, len(response.content), latency, count_data(json_response))
+
+        if response.status_code != 429:
+            break
+        if attempt < max_rate_limit_waits:
+            print("Rate limit reached (429: Too many requests). Waiting until rate limit reset.")
 
     handled_quietly = {200, 429}
 
@@ -95,33 +134,34 @@ def connect_to_endpoint(url, params, bearer_token) -> tuple:
                 response.status_code, response.text
             )
         )
-    return (response.json(), response.status_code)
+    return (json_loads(response.content) if json_response is None else json_response, response.status_code)
+
+
+def count_data(json_response) -> int:
+    """Number of tweets (or users) in the "data" field of an API response."""
+    if not isinstance(json_response, dict):
+        return 0
+    data = json_response.get("data", [])
+    return len(data) if isinstance(data, list) else 1
+
+
+def count_queried(n) -> None:
+    """Adds {n} to N_TWEETS_QUERIED. Safe to call from several threads."""
+    global N_TWEETS_QUERIED
+    with _counter_lock:
+        N_TWEETS_QUERIED += n
 
 
 def merge_user_data(tweets_list, users_list) -> list:
     """
     Helper function needed while querying the Twitter API.
     Takes the ["data"] and ["includes"]["users"] lists from the json_response,
-    adds user parameters to their respective tweets matching "author_id" & "id"
+    returns a compact TweetRecord per tweet with the user parameters of its
+    author (matching "author_id" & "id") added.
     """
-    out_list = []
     users_dict = {u["id"]: u for u in users_list}
-
-    # Iterate over all tweets & copy over their user information from users_list
-    for t in tweets_list:
-
-        user_id = t["author_id"]
-        u = users_dict[user_id]
-
-        t["username"] = u["username"]
-        t["followers_count"] = u["public_metrics"]["followers_count"]
-        t["following_count"] = u["public_metrics"]["following_count"]
-        t["tweet_count"] = u["public_metrics"]["tweet_count"]
-        t["listed_count"] = u["public_metrics"]["listed_count"]
-        
-        out_list.append(t)
-
-    return out_list
+    with paused_gc():
+        return [TweetRecord.from_api(t, users_dict[t["author_id"]]) for t in tweets_list]
 
 
 def simple_query(url, params, bearer_token, infinite=False) -> list:
@@ -130,80 +170,86 @@ def simple_query(url, params, bearer_token, infinite=False) -> list:
     Returns tuple (list_of_tweets, response_status_code).
     Tweets causing Authorization or Not Found Error are dropped.
     """
-    global N_TWEETS_QUERIED
     json_response, status_code = connect_to_endpoint(url, params, bearer_token)
 
-    if status_code == 429:
-        print("Rate limit reached (429: Too many requests). Waiting for 16m to continue querying.")
-        sleep(16*60)
-        json_response, status_code = connect_to_endpoint(url, params, bearer_token)
-    
     if "errors" in json_response:
         [print(x["title"] + ":", x["detail"]) for x in json_response["errors"]]
     if "data" not in json_response:
         return ([], status_code)
 
     tweets = json_response["data"]
-    N_TWEETS_QUERIED += len(tweets)
+    count_queried(len(tweets))
     users = json_response["includes"]["users"]
     merged = merge_user_data(tweets, users)
 
     return (merged, status_code)
 
 
-def paginated_query(url, params, bearer_token, infinite=False) -> list:
+def iter_pages(url, params, bearer_token, infinite=False, archive_as=None):
     """
-    Queries pagewise for max results until last page. Returns list of tweets
-    and most recent query status code. Will abort if no end_trigger is set,
-    unless "infinite" is set to True.
+    Queries pagewise for max results until last page. Yields a tuple (list_of_tweets,
+    status_code) per page, with user data already added. Only one page is held in memory
+    at a time. Will abort if no end_trigger is set, unless "infinite" is set to True.
+    Progress is checkpointed to disk: If querying stops early, the next call with the same
+    {url} & {params} replays the pages fetched so far & continues where it stopped.
+    Each fetched page is archived as batch {archive_as} (skipped if None) as received.
     """
-    global N_TWEETS_QUERIED
     if not infinite:
         assert ("since_id" or "start_time" in params), ("No end for querying defined. Will query until rate limit reached!")
 
-    tweets_list = []
-    users_list = []
-
-    # First query. If no results & no error -> Return emtpy list
-    json_response, status_code = connect_to_endpoint(url, params, bearer_token)
-
-    # If rate limit reached (TooManyRequests) -> wait for 16m and continue querying
-    if status_code == 429:
-            print("Rate limit reached (429: Too many requests). Waiting for 16m to continue querying.")
-            sleep(16*60)
-            json_response, status_code = connect_to_endpoint(url, params, bearer_token)
-
-    # If end of data reached (last page) -> abort here & return emtpy list
-    meta = json_response["meta"]
-    if "data" not in json_response:
-        return ([], status_code)
-
-    # Else continue querying until last (=oldest) page reached
-    tweets = json_response["data"]
-    users = json_response["includes"]["users"]
+    params = dict(params)
+    checkpoint = Checkpoint(url, params)
+    state = checkpoint.load()
 
-    tweets_list.extend(tweets)
-    users_list.extend(users)
+    # Resume an unfinished query without querying its pages again
+    if state is not None:
+        print(f"Resuming {url} after {state['pages']} pages ({state['tweets']} tweets).")
+        for tweets in checkpoint.replay():
+            yield (as_records(tweets), 200)
+        params["pagination_token"] = state["next_token"]
 
-    N_TWEETS_QUERIED += len(tweets)
+    while True:
+        json_response, status_code = connect_to_endpoint(url, params, bearer_token)
 
-    # Query for a next page as long as there is one & API rate limit is not exceeded
-    while ("next_token" in meta) and status_code != 429:
+        # If rate limit still exceeded after waiting -> give up (checkpoint stays for next run)
+        if status_code == 429:
+            if "pagination_token" in params:
+                print("Rate limit still exceeded. Returning tweets fetched so far.")
+            yield ([], status_code)
+            return
 
-        params["pagination_token"] = meta["next_token"]
-        json_response, status_code = connect_to_endpoint(url, params, bearer_token)
         meta = json_response["meta"]
+        tweets = []
 
         if "data" in json_response:
-
+            if archive_as is not None:
+                archive_page(json_response, archive_as)
             tweets = json_response["data"]
             users = json_response["includes"]["users"]
-            tweets_list.extend(tweets)
-            users_list.extend(users)
-            N_TWEETS_QUERIED += len(tweets)
+            count_queried(len(tweets))
+            tweets = merge_user_data(tweets, users)
+
+        # If end of data reached (last page) -> nothing left to resume
+        if "next_token" not in meta:
+            yield (tweets, status_code)
+            checkpoint.clear()
+            return
+
+        # Save progress before handing out the page, then query the next one
+        checkpoint.save_page(tweets, meta["next_token"])
+        yield (tweets, status_code)
+        params["pagination_token"] = meta["next_token"]
 
-    # Add user data back to original tweets
-    out_list = merge_user_data(tweets_list, users_list)
+
+def paginated_query(url, params, bearer_token, infinite=False, archive_as=None) -> list:
+    """
+    Queries pagewise for max results until last page. Returns list of tweets
+    and most recent query status code. Will abort if no end_trigger is set,
+    unless "infinite" is set to True. Pages are archived as in iter_pages().
+    """
+    out_list = []
+    for tweets, status_code in iter_pages(url, params, bearer_token, infinite=infinite, archive_as=archive_as):
+        out_list.extend(tweets)
 
     return (out_list, status_code)
 
@@ -217,78 +263,49 @@ def parse_date_range(tweets: list) -> str:
     return f"{earliest} - {latest}"
 
 
-def get_cutoffs(csv_path) -> dict:
+def get_cutoffs(db_path) -> dict:
     """
-    Loads DataFrame from {csv_path}. Searches through column "source".
-    Returns a dictionary of type {func_1: "<highest tweet id>", ...}
+    Returns a dictionary of type {func_1: "<highest tweet id>", ...} as kept up
+    to date by the database in {db_path} whenever tweets are saved.
     """
+    return read_cutoffs(db_path)
 
-    cutoff_d = {}
-    js_tweet_ids = set()
-
-    # Load df
-    df = csv_to_df(csv_path)
-
-    # Get most recent mention, skip if none found
-    mentions = df[df["source"] == "get_new_mentions()"]["id"].tolist()
-    if mentions != []:
-        cutoff_d["get_new_mentions()"] = max(mentions)
-
-    # Get ids of quoted JediSwap tweets
-    quoted_referenced_tweets = df[df["source"] == "get_quotes_for_tweet()"]["referenced_tweets"]
-
-    for l in quoted_referenced_tweets:
-        referenced_tweets_list = literal_eval(l)
-        for t in referenced_tweets_list:
-            if t["type"] == "quoted":
-                js_tweet_ids.add(t["id"])
-
-    # Add most recent id of quoted tweets, skip if none found.
-    if js_tweet_ids != set():
-        cutoff_d["get_quotes_for_tweet()"] = max(js_tweet_ids)
 
-    return cutoff_d
-
-
-def tweets_to_json(tweets: list, name: str) -> None:
-    """Saves a tweets list to json. Appends its date range to name."""
-    if tweets == []:
-        return f"EMPTY {name}.json"
-
-    date_range = parse_date_range(tweets)
-    out_name = f"{date_range} unfiltered {name}.json"
-    write_list_to_json(tweets, out_name)
+@timed("json_backup")
+def archive_page(json_response, name: str) -> str:
+    """
+    Appends the tweets & includes of an API response as backup to the compressed archive
+    (see archive.py), before user data is merged in. Returns path of the archive file.
+    """
+    return append_page(json_response, name)
 
 
-def query_tweets(url, params, bearer_token) -> list:
+def query_tweets(url, params, bearer_token, archive_as=None) -> list:
     """
     Queries for multiple (max 100) tweets. Merges user & tweet data.
     Returns list of tweets and most recent query status code.
+    The response is archived as batch {archive_as} (skipped if None).
     """
-    global N_TWEETS_QUERIED
     tweets_list = []
     users_list = []
 
     # Query. If no results & no error -> Return emtpy list
     json_response, status_code = connect_to_endpoint(url, params, bearer_token)
 
-    # If rate limit reached (TooManyRequests) -> wait for 16m and continue querying
-    if status_code == 429:
-            print("Rate limit reached (429: Too many requests). Waiting for 16m to continue querying.")
-            sleep(16*60)
-            json_response, status_code = connect_to_endpoint(url, params, bearer_token)
-
     # If nothing found -> abort here & return emtpy list
     if "data" not in json_response:
         return ([], status_code)
 
+    if archive_as is not None:
+        archive_page(json_response, archive_as)
+
     # Merge tweet data with corresponding user data
     tweets = json_response["data"]
     users = json_response["includes"]["users"]
     tweets_list.extend(tweets)
     users_list.extend(users)
 
-    N_TWEETS_QUERIED += len(tweets)
+    count_queried(len(tweets))
 
     # Add user data back to original tweets
     out_list = merge_user_data(tweets_list, users_list)
@@ -296,53 +313,118 @@ def query_tweets(url, params, bearer_token) -> list:
     return (out_list, status_code)
 
 
-def get_tweets(id_list, bearer_token, add_params=None) -> list:
+def lookup_ids(id_list, params, bearer_token, max_workers=lookup_workers, archive_as=None) -> list:
     """
-    Assumes list of tweet ids.
-    Queries Twitter API in chunks of 100 tweets per query (maximum).
-    Returns list of tweet dictionaries.
+    Queries tweets by id in chunks of 100 ids per query (maximum), keeping up to
+    {max_workers} queries in flight. Only failed chunks are retried. Returns list
+    of found tweets with user data added. Responses are archived as in query_tweets().
     """
     def chunk_list(_list, n):
         for i in range(0, len(_list), n):
             yield _list[i:i+n]
 
-    out_tweets = []
     tweets_per_query = 100
     id_chunk = list(chunk_list(id_list, tweets_per_query))
 
+    def lookup(i) -> tuple:
+        id_str = "ids=" + ",".join(id_chunk[i])
+        url = "{}/2/tweets?{}".format(api_base_url, id_str)
+        try:
+            return query_tweets(url, params, bearer_token, archive_as)
+        except Exception as e:
+            print(f"Lookup of {len(id_chunk[i])} tweet ids failed: {e}")
+            return (None, None)
+
+    # Query 100 tweets at a time, several chunks in parallel
+    results = [None] * len(id_chunk)
+    pending = list(range(len(id_chunk)))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for attempt in range(lookup_retries + 1):
+            if pending == []:
+                break
+            if attempt > 0:
+                print(f"Retrying {len(pending)} failed lookups...")
+
+            failed = []
+            for i, (tweets, status_code) in zip(pending, executor.map(lookup, pending)):
+                if tweets is None or status_code == 429:
+                    failed.append(i)
+                else:
+                    results[i] = tweets
+            pending = failed
+
+    if pending != []:
+        n_skipped = sum(len(id_chunk[i]) for i in pending)
+        print(f"Gave up on {len(pending)} lookups. Skipped {n_skipped} tweet ids.")
+
+    return [t for tweets in results if tweets for t in tweets]
+
+
+@timed()
+def get_tweets(id_list, bearer_token, add_params=None, max_workers=lookup_workers,
+               fresh_metrics=True) -> list:
+    """
+    Assumes list of tweet ids.
+    Tweets found in TWEET_CACHE are not queried again. If {fresh_metrics} is set,
+    only cache entries with metrics younger than the cache's TTL count as hits.
+    Custom {add_params} bypass the cache. Missing tweets are queried via lookup_ids().
+    Returns list of tweet dictionaries in the order of {id_list}.
+    """
+    # Serve tweets known from earlier runs from cache
+    cached = {} if add_params else TWEET_CACHE.get_many(id_list, need_metrics=fresh_metrics)
+    cached = dict(zip(cached, as_records(cached.values())))
+    missing = [i for i in dict.fromkeys(id_list) if i not in cached]
+    if not add_params:
+        print(f"Tweet cache: {len(cached)} hits, {len(missing)} misses.")
+
     params = get_query_params()
     if add_params:
         params.update(add_params)
     del params["max_results"]
-    
-    # Query 100 tweets at a time
-    for ids in id_chunk:
-        
-        id_str = "ids=" + ",".join(ids)
-        url = "https://api.twitter.com/2/tweets?{}".format(id_str)
-        tweets, status_code = query_tweets(url, params, bearer_token)
-        out_tweets.extend(tweets)
 
-        if status_code == 429:
-                print("Rate limit reached (429: Too many requests). Waiting for 16m to continue querying.")
-                sleep(16*60)
-                tweets, status_code = query_tweets(url, params, bearer_token)
-                out_tweets.extend(tweets)
+    if offline:
+        if missing != []:
+            print(f"Offline: skipped lookup of {len(missing)} tweets not in cache.")
+        missing = []
+
+    func_name = str(inspect.currentframe().f_code.co_name + "()")
+    fetched = lookup_ids(missing, params, bearer_token, max_workers, archive_as=func_name)
+
+    # De-truncate tweets longer than 140 chars & remember them for later runs
+    fetched = de_truncate(fetched)
+    if fetched != [] and not add_params:
+        TWEET_CACHE.put_many(fetched)
+
+    found = dict(cached)
+    found.update({t["id"]: t for t in fetched})
+    out_tweets = [found[i] for i in dict.fromkeys(id_list) if i in found]
 
     if out_tweets == []:
         return []
 
-    # De-truncate tweets longer than 140 chars
-    out_tweets = de_truncate(out_tweets)
-
-    # Add function name to tweets & save queried data to json as backup
-    func_name = str(inspect.currentframe().f_code.co_name + "()")
+    # Add function name to tweets
     [x.update({"source": func_name}) for x in out_tweets]
-    tweets_to_json(out_tweets, func_name)
 
     return out_tweets
 
 
+@timed()
+def get_metrics(id_list, bearer_token, max_workers=lookup_workers) -> list:
+    """
+    Queries only the current public metrics of tweets & of their authors ({metrics_params}),
+    bypassing TWEET_CACHE. Responses are a fraction of the size of full lookups. Deleted
+    tweets & tweets of suspended accounts are missing from the output. Returns list of
+    {id, author_id, public_metrics, username, <user metrics>} in the order of {id_list}.
+    The partial responses aren't archived.
+    """
+    ids = list(dict.fromkeys(id_list))
+    print(f"Refreshing metrics of {len(ids)} tweets...")
+    fetched = {t["id"]: t for t in lookup_ids(ids, dict(metrics_params), bearer_token, max_workers)}
+    return [fetched[i] for i in ids if i in fetched]
+
+
+@timed()
 def get_new_mentions(user_id, bearer_token, add_params=None) -> list:
     """
     Queries mentions timeline of Twitter user until tweet id from
@@ -351,31 +433,26 @@ def get_new_mentions(user_id, bearer_token, add_params=None) -> list:
     """
 
     # Define query parameters
-    url = "https://api.twitter.com/2/users/{}/mentions".format(user_id)
+    url = "{}/2/users/{}/mentions".format(api_base_url, user_id)
     params = get_query_params()
 
     # Add any additional query parameters from {add_params} dictionary
     if add_params:
         params.update(add_params)
 
-    # Query for tweets. Skip rest if no results or rate limit reached.
-    new_mentions, status_code = paginated_query(url, params, bearer_token)
+    # Query for tweets, archiving each page. Skip rest if no results or rate limit reached.
+    func_name = str(inspect.currentframe().f_code.co_name + "()")
+    new_mentions, status_code = paginated_query(url, params, bearer_token, archive_as=func_name)
 
     if status_code == 429:
-        print(f"Api rate limit reached. Waiting for 16m to get new mentions for user {user_id}.")
-        sleep(16*60)
-        new_mentions, status_code = paginated_query(url, params, bearer_token)
+        print(f"Api rate limit reached. Stopped querying for new mentions of user {user_id}.")
 
     if new_mentions == []:
         return []
 
     # Add source attribute to tweets to trace potential bugs back to origin
-    func_name = str(inspect.currentframe().f_code.co_name + "()")
     [x.update({"source": func_name}) for x in new_mentions]
 
-    # Save queried data to json as backup
-    tweets_to_json(new_mentions, func_name)
-
     return new_mentions
 
 
@@ -387,20 +464,19 @@ def get_new_tweets_by_user(user_id, bearer_token, add_params=None) -> list:
     """
 
     # Define query parameters
-    url = "https://api.twitter.com/2/users/{}/tweets".format(user_id)
+    url = "{}/2/users/{}/tweets".format(api_base_url, user_id)
     params = get_query_params()
 
     # Add any additional query parameters from {add_params} dictionary
     if add_params:
         params.update(add_params)
 
-    # Query for tweets. Skip rest if no results
-    new_tweets, status_code = paginated_query(url, params, bearer_token)
+    # Query for tweets, archiving each page. Skip rest if no results
+    func_name = str(inspect.currentframe().f_code.co_name + "()")
+    new_tweets, status_code = paginated_query(url, params, bearer_token, archive_as=func_name)
 
     if status_code == 429:
         print(f"Api rate limit reached. Stopped querying for tweets by user {user_id}.")
-        sleep(16*60)
-        new_tweets, status_code = paginated_query(url, params, bearer_token)
 
     if new_tweets == []:
         return []
@@ -409,45 +485,40 @@ def get_new_tweets_by_user(user_id, bearer_token, add_params=None) -> list:
     new_tweets = [t for t in new_tweets if not t["text"].startswith("RT")]
 
     # Add source attribute to tweets to trace potential bugs back to origin
-    func_name = str(inspect.currentframe().f_code.co_name + "()")
     [x.update({"source": func_name}) for x in new_tweets]
 
-    # Save queried data to json as backup
-    tweets_to_json(new_tweets, func_name)
-
     return new_tweets
 
 
 def get_quotes_for_tweet(tweet_id, bearer_token) -> tuple:
     """Queries API for all quote tweets of {tweet_id}."""
 
-    # Define query parameters & query for tweets. Skip rest if no results
-    url = "https://api.twitter.com/2/tweets/{}/quote_tweets".format(tweet_id)
+    # Define query parameters & query for tweets, archiving each page. Skip rest if no results
+    url = "{}/2/tweets/{}/quote_tweets".format(api_base_url, tweet_id)
     params = get_query_params()
-    quotes, status_code = paginated_query(url, params, bearer_token, infinite=True)
+    func_name = str(inspect.currentframe().f_code.co_name + "()")
+    quotes, status_code = paginated_query(url, params, bearer_token, infinite=True, archive_as=func_name)
 
     if status_code == 429:
         print(f"Api rate limit reached while querying quote tweets of tweet {tweet_id}.")
-        print("Waiting for 16m and continuing to query after.")
-        sleep(16*60)
-        quotes, status_code = paginated_query(url, params, bearer_token, infinite=True)
 
     if quotes == []:
         return ([], status_code)
 
     # Add source attribute to tweets to trace potential bugs back to origin
-    func_name = str(inspect.currentframe().f_code.co_name + "()")
     [x.update({"source": func_name}) for x in quotes]
 
     return (quotes, status_code)
 
 
-def get_new_quote_tweets(user_id, bearer_token, add_params=None) -> list:
+@timed()
+def get_new_quote_tweets(user_id, bearer_token, add_params=None, max_workers=quote_workers) -> list:
     """
     Queries API for all JediSwap tweets since the tweet id stored in the
     json file in {last_queried_path}. Discards retweets, iterates through
     results & returns all quote tweets for these tweets.
     Updates json from {last_queried_path} with new most recent JediSwap tweet id.
+    Quotes of up to {max_workers} tweets are queried at the same time.
     """
 
     new_quotes = []
@@ -460,24 +531,27 @@ def get_new_quote_tweets(user_id, bearer_token, add_params=None) -> list:
 
     print(f"In get_new_quote_tweets(): Getting quotes for {len(tweet_ids)} tweets...")
 
-    # Get quotes of each new tweet
-    for t_id in tweet_ids:
-        quotes, status_code = get_quotes_for_tweet(t_id, bearer_token)
+    # Get quotes of each new tweet. Results keep the order of {tweet_ids}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        results = executor.map(lambda t_id: get_quotes_for_tweet(t_id, bearer_token), tweet_ids)
+        for quotes, status_code in results:
+            new_quotes.extend(quotes)
 
-        # If api limit reached -> Abort & return what was fetched so far
-        if status_code == 429:
-            print(f"Rate limit reached. Waiting for 16m. Paused fetching quote tweets at tweet {t_id}.")
-            sleep(16*60)
-            quotes, status_code = get_quotes_for_tweet(t_id, bearer_token)
+    return new_quotes
 
-        new_quotes.extend(quotes)
 
-    if new_quotes != []:
-        # Save queried data to json as backup
-        func_name = str(inspect.currentframe().f_code.co_name + "()")
-        tweets_to_json(new_quotes, func_name)
+def save_discarded(discarded, discarded_json_path, overwrite=True) -> None:
+    """
+    Saves a dictionary {filter name: [tweets]} of discarded tweets to {discarded_json_path}
+    (for debugging, skipped if None) & adds them to the discard log (for keeping track of filters).
+    """
+    if discarded_json_path is not None:
+        out_d = {} if (overwrite or not exists(discarded_json_path)) else read_from_json(discarded_json_path)
+        out_d.update(discarded)
+        write_to_json(out_d, discarded_json_path)
 
-    return new_quotes
+    for discarded_key, tweets in discarded.items():
+        DISCARD_LOG.add(tweets, reason=discarded_key)
 
 
 def remove_if_regex_matches(tweets, regex_p, discarded_json_path, discarded_key, regex_flag=None) -> list:
@@ -486,117 +560,104 @@ def remove_if_regex_matches(tweets, regex_p, discarded_json_path, discarded_key,
     Saves/overwrites all discarded tweets to {discarded_json_path}, according to the
     {discarded_key} specified.
     """
-    discarded = []
-    out_tweets = []
-    flags = 0
-
-    if regex_flag == "multiline":
-        flags = re.M
-    if regex_flag == "dotall":
-        flags |= re.S
-    if regex_flag == "verbose":
-        flags |= re.X
-    if regex_flag == "ignorecase":
-        flags |= re.I
-    if regex_flag == "uni_code":
-        flags |= re.U
-
-    # Drop each tweet where regex matches
-    for t in tweets:
-        if re.search(regex_p, t["text"], flags=flags):
-            discarded.append(t)
-        else:
-            out_tweets.append(t)
-
-    # Save discarded tweets to json (for debugging)
-    out_d = read_from_json(discarded_json_path)
-    out_d[discarded_key] = discarded
-    write_to_json(out_d, discarded_json_path)
-
-    # Append discarded tweets to csv (for keeping track of filters)
-    csv_path = discarded_json_path.replace(".json", f"_{discarded_key}.csv")
-
-    if discarded != []:
-        include = ["id", "text", "created_at", "username", "author_id"]
-        new_data = pd.DataFrame(discarded)[include]
-
-        if exists(csv_path):
-            known_data = csv_to_df(csv_path)
-            new_data = pd.concat([known_data, new_data]) \
-                .drop_duplicates("id") \
-                .sort_values("id")
-        
-        df_to_csv(new_data, csv_path)
-        #new_data.to_csv(csv_path, index=False, header=not exists(csv_path))
+    f = {"name": discarded_key, "pattern": regex_p, "flag": regex_flag}
+    out_tweets, discarded = classify_tweets(tweets, [f])
+    save_discarded(discarded, discarded_json_path, overwrite=False)
 
     return out_tweets
 
 
+@timed()
 def apply_filters(tweets, filters, discarded_json_path) -> list:
     """
     Takes a list of tweets. Returns the same list with all tweets removed where a regex pattern from
     {filter_patterns} matches in tweet["text"]. Discarded tweets are stored in json file, ordered by
-    filter name.
+    filter name (if {discarded_json_path} isn't None). All filters are compiled once & applied in a
+    single pass; each discarded tweet is recorded under the first filter that matched.
     """
+    out_tweets, discarded = classify_tweets(tweets, filters)
 
-    # Wipe old json file
-    write_to_json(dict(), discarded_json_path)
-
-    # Apply regex filters iteratively
-    for f in filters:
+    # Overwrite old json file & add to discard log once
+    save_discarded(discarded, discarded_json_path)
 
-        tweets = remove_if_regex_matches(
-            tweets,
-            regex_p=f["pattern"],
-            discarded_json_path=discarded_json_path,
-            discarded_key=f["name"],
-            regex_flag=f["flag"]
-        )
-
-    return tweets
+    return out_tweets
 
 
-def scrape_image_tags(tweet_dict) -> list:
+@timed()
+def fetch_image_tags(tweet_dict) -> list:
     """
     Scrapes all Twitter accounts tagged in an image within a single tweet and returns them as a list.
     This needs to be scraped from web since it's not supported via official Twitter API 2.0.
+    Uses a browser from the shared pool & waits only until the media tags modal lists the tagged users.
+    Raises if the page couldn't be scraped.
     """
     tweet_id = tweet_dict["id"]
-    username = tweet_dict["username"]
     print(f"Scraping image tags for tweet {tweet_id}...")
-    
-    # Construct url
-    target_url = 'https://twitter.com/' + username + '/status/' + str(tweet_id) + '/media_tags'
-    
-    # Scrape Twitter frontend web content for this tweet
-    options = Options()
-    options.add_argument("--user-data-dir=ChromeUserData")
-    options.add_argument("--remote-debugging-port=9222")
-    options.page_load_strategy = 'normal'
-    driver = webdriver.Chrome(options=options)
-    
-    try:
-        driver.get(target_url)
-        sleep(80)
-        resp = driver.page_source
-        soup = BeautifulSoup(resp, 'html.parser')
-
-        # Parse users from frontend modal to list
-        modal = soup.find("div", {"role":"group"})
-        users = modal.find_all("div",{"class":"css-1rynq56 r-dnmrzs r-1udh08x r-3s2u2q r-bcqeeo r-qvutc0 r-37j5jr r-a023e6 r-rjixqe r-16dba41 r-18u37iz r-1wvb978"})
-        tagged_users_list = [x.text.replace('@', '') for x in users]
-        print(f"Done. Got these tagged users: {tagged_users_list}")
-        
-    except:
-        tagged_users_list = []
-        print(f"Couldn't scrape {target_url}. Returned empty list of users tagged in media.")
 
-    finally:
-        driver.close()
-    
+    # Scrape Twitter frontend web content for this tweet & parse users from modal to list
+    html = get_browser_pool().fetch(media_tags_url(tweet_dict))
+    tagged_users_list = parse_tagged_users(html)
+    print(f"Done. Got these tagged users: {tagged_users_list}")
     return tagged_users_list
 
 
+def scrape_image_tags(tweet_dict, default=None) -> list:
+    """Like fetch_image_tags(), but returns a copy of {default} (None: []) if the page couldn't be scraped."""
+    try:
+        return fetch_image_tags(tweet_dict)
+    except Exception:
+        tagged_users_list = [] if default is None else list(default)
+        print(f"Couldn't scrape {media_tags_url(tweet_dict)}. Returned {tagged_users_list} as users tagged in media.")
+        return tagged_users_list
+
+
+def scrape_image_tags_many(tweet_dicts) -> dict:
+    """
+    Scrapes image tags of several tweets at once, one tweet per pooled browser.
+    Returns a dictionary of type {tweet_id: tagged_users_list}. Failed scrapes map to None.
+    """
+    if tweet_dicts == []:
+        return {}
+
+    def scrape(tweet_dict):
+        try:
+            return fetch_image_tags(tweet_dict)
+        except Exception:
+            print(f"Couldn't scrape {media_tags_url(tweet_dict)}.")
+            return None
+
+    n_workers = get_browser_pool().size
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(scrape, tweet_dicts)
+        return {t["id"]: tags for t, tags in zip(tweet_dicts, results)}
+
+
+def get_image_tags(tweet_dicts) -> dict:
+    """
+    Returns {tweet_id: tagged_users_list} for all {tweet_dicts}. Tags are read from
+    the media tag store if known, else scraped & stored. Failed scrapes are recorded
+    & not retried before their backoff expires. They map to an empty list meanwhile.
+    """
+    tweet_dicts = {t["id"]: t for t in tweet_dicts}
+    tags, backing_off = MEDIA_TAGS.lookup(tweet_dicts.keys())
+    to_scrape = [t for _id, t in tweet_dicts.items() if _id not in tags and _id not in backing_off]
+
+    if backing_off != set():
+        print(f"Skipped scraping {len(backing_off)} tweets that failed recently.")
+    if offline and to_scrape != []:
+        print(f"Offline: skipped scraping {len(to_scrape)} tweets without stored media tags.")
+        to_scrape = []
+
+    for tweet_id, tagged_users_list in scrape_image_tags_many(to_scrape).items():
+        if tagged_users_list is None:
+            MEDIA_TAGS.record_failure(tweet_id)
+        else:
+            MEDIA_TAGS.put(tweet_id, tagged_users_list)
+            tags[tweet_id] = tagged_users_list
+
+    return {_id: tags.get(_id, []) for _id in tweet_dicts}
+
+
 def de_truncate(tweets_list) -> list:
     
     for t in tweets_list:
@@ -627,6 +688,7 @@ def de_truncate(tweets_list) -> list:
     return tweets_list
 
 
+@timed()
 def discount_mentions(tweets_dict) -> dict:
     """
     Tweets fetched from the mentions timeline might not mention JediSwap at all, but
@@ -634,7 +696,6 @@ def discount_mentions(tweets_dict) -> dict:
     For reply tweets, this method subtracts mentions that have been present in the tweet
     that's been replied to. For replies to JediSwap, the mention is discounted in any case.
     """
-    global MEDIA_TWEETS
     discarded = []
     reply_ids = set()
 
@@ -712,9 +773,20 @@ def discount_mentions(tweets_dict) -> dict:
             parent_tweet_id = get_reply_id(t)
             reply_ids.add(parent_tweet_id)
     
-    # Query tweet data & create dict for these "parent tweets"
-    tweets_list = get_tweets(list(reply_ids), bearer_token)
+    # Query tweet data & create dict for these "parent tweets". Only text & entities are needed.
+    tweets_list = get_tweets(list(reply_ids), bearer_token, fresh_metrics=False)
     parent_tweets = {t["id"]: t for t in tweets_list}
+
+    # Get photo tags of all parent tweets with media ahead of the loop below (stored or scraped)
+    media_parents = {}
+    for t in tweets_dict.values():
+        if is_quote(t) or is_reply_to_jediswap(t) or not is_reply(t):
+            continue
+        parent_id = get_reply_id(t)
+        if parent_id in parent_tweets and contains_media(parent_tweets[parent_id]):
+            media_parents[parent_id] = parent_tweets[parent_id]
+
+    image_tags = get_image_tags(list(media_parents.values()))
     
     # Discount mentions inherited from other tweets & drop conditionally from data
     for _id, t in tweets_dict.items():
@@ -742,13 +814,8 @@ def discount_mentions(tweets_dict) -> dict:
                 
                 # Get photo tags of parent tweet and add to mentions 
                 if contains_media(parent_tweet_dict):
-                    if parent_id in MEDIA_TWEETS:
-                        tagged_users_list = MEDIA_TWEETS[parent_id]["tagged_users_list"]
-                    else:
-                        tagged_users_list = scrape_image_tags(parent_tweet_dict)
-                        parent_tweet_dict["tagged_users_list"] = tagged_users_list
-                        MEDIA_TWEETS[parent_id] = parent_tweet_dict
-                        
+                    tagged_users_list = image_tags[parent_id]
+                    parent_tweet_dict["tagged_users_list"] = tagged_users_list
                     parent_mentions.extend(tagged_users_list)
 
             # Case: Tweet is reply to deleted tweet: Nothing to remove
@@ -775,35 +842,19 @@ def discount_mentions(tweets_dict) -> dict:
                 discarded.append(t)
                 del out_dict[_id]
     
-    # Append discarded tweets to csv (to keep track of all filtered out tweets)
-    csv_path = "not_mentioning_jediswap.csv"
-
+    # Log discarded tweets (to keep track of all filtered out tweets)
     if discarded != []:
-        include = ["id", "text", "comment", "created_at", "username", "author_id", "source"]
-        new_data = pd.DataFrame(discarded)[include]
-
-        if exists(csv_path):
-            known_data = csv_to_df(csv_path)
-            new_data = pd.concat([known_data, new_data]) \
-                .drop_duplicates("id") \
-                .sort_values("id")
-        
-        df_to_csv(new_data, csv_path)
-        print(f"Sorted out {len(discarded)} tweets not actually mentioning jediswap. See {csv_path}.")
+        DISCARD_LOG.add(discarded, reason=not_mentioning_reason)
+        print(f"Sorted out {len(discarded)} tweets not actually mentioning jediswap. See {DISCARD_LOG.path}.")
 
     return out_dict
 
 
-def get_filtered_tweets(cutoff_ids=None, add_params=None) -> dict:
+def get_end_params(cutoff_ids=None, add_params=None) -> tuple:
     """
-    Main wrapper function. Calls query functions, applies filtering, returns dictionary
-    of filtered tweets. Queries backwards in time. End triggers can be defined in
-    {add_params} (all queries) or {cutoff_ids} (per function). Examples:
-    cutoff_ids = {"get_new_mentions()": "<tweet id>", "get_new_quotes()":<other tweet id>"}
-    add_params = {"start_time" = "2023-03-01T00:00:00.000Z"}
+    Returns tuple (new_mentions_params, new_quotes_params) with the end triggers for querying
+    from {add_params} (preferred, all queries) or {cutoff_ids} (per function).
     """
-    obvious_print("Fetching new tweets...")
-
     if cutoff_ids:
         print(f"Querying until tweet ids:")
         [print(f"{k}\t{v}") for k, v in cutoff_ids.items()]
@@ -829,6 +880,20 @@ def get_filtered_tweets(cutoff_ids=None, add_params=None) -> dict:
     else:
         pass
 
+    return (new_mentions_params, new_quotes_params)
+
+
+def get_filtered_tweets(cutoff_ids=None, add_params=None) -> dict:
+    """
+    Main wrapper function. Calls query functions, applies filtering, returns dictionary
+    of filtered tweets. Queries backwards in time. End triggers can be defined in
+    {add_params} (all queries) or {cutoff_ids} (per function). Examples:
+    cutoff_ids = {"get_new_mentions()": "<tweet id>", "get_new_quotes()":<other tweet id>"}
+    add_params = {"start_time" = "2023-03-01T00:00:00.000Z"}
+    """
+    obvious_print("Fetching new tweets...")
+    new_mentions_params, new_quotes_params = get_end_params(cutoff_ids, add_params)
+
     # Fetch all mentions new since last execution of script
     new_mentions = get_new_mentions(
         target_user_id,
@@ -858,6 +923,63 @@ def get_filtered_tweets(cutoff_ids=None, add_params=None) -> dict:
     return out_d
 
 
+def iter_new_pages(new_mentions_params, new_quotes_params):
+    """
+    Yields tuples (source, list_of_tweets) per page of API results: first all new
+    mentions, then the quote tweets of each new JediSwap tweet.
+    """
+    url = "{}/2/users/{}/mentions".format(api_base_url, target_user_id)
+    params = get_query_params()
+    params.update(new_mentions_params)
+
+    for tweets, status_code in iter_pages(url, params, bearer_token, archive_as="get_new_mentions()"):
+        yield ("get_new_mentions()", tweets)
+    if status_code == 429:
+        print(f"Api rate limit reached. Stopped querying for new mentions of user {target_user_id}.")
+
+    new_jediswap_tweets = get_new_tweets_by_user(target_user_id, bearer_token, add_params=new_quotes_params)
+    print(f"In iter_new_pages(): Getting quotes for {len(new_jediswap_tweets)} tweets...")
+
+    for t in new_jediswap_tweets:
+        url = "{}/2/tweets/{}/quote_tweets".format(api_base_url, t["id"])
+        for tweets, status_code in iter_pages(url, get_query_params(), bearer_token, infinite=True,
+            archive_as="get_quotes_for_tweet()"):
+            yield ("get_quotes_for_tweet()", tweets)
+        if status_code == 429:
+            print(f"Api rate limit reached while querying quote tweets of tweet {t['id']}.")
+
+
+def stream_filtered_tweets(cutoff_ids=None, add_params=None):
+    """
+    Streaming version of get_filtered_tweets() followed by discount_mentions(). Yields a
+    dictionary of filtered tweets per page of API results, so only one page is held in
+    memory & each page can be saved as soon as it arrives. Discarded tweets only go to
+    the discard log, not to {discarded_path}.
+    """
+    obvious_print("Streaming new tweets...")
+    new_mentions_params, new_quotes_params = get_end_params(cutoff_ids, add_params)
+    seen_ids = set()
+
+    for source, tweets in iter_new_pages(new_mentions_params, new_quotes_params):
+
+        # Keep only 1 entry per tweet id (mentions come first, as in get_filtered_tweets)
+        tweets = [t for t in tweets if t["id"] not in seen_ids]
+        if tweets == []:
+            continue
+        seen_ids.update(t["id"] for t in tweets)
+
+        # Add source attribute (the page was archived by iter_pages)
+        [t.update({"source": source}) for t in tweets]
+
+        # Same steps as without streaming, one page at a time
+        tweets = de_truncate(tweets)
+        tweets = apply_filters(tweets, filter_patterns, None)
+        if tweets == []:
+            continue
+
+        out_d = discount_mentions({t["id"]: t for t in tweets})
+        if out_d != {}:
+            yield out_d
 
 if __name__ == "__main__":
     get_filtered_tweets()
@@ -0,0 +1,240 @@
+"""
+Rate-limit-aware request scheduler. Keeps one token bucket per API endpoint,
+filled from the x-rate-limit-* response headers. Requests are paced ahead of
+time so the API rarely answers with 429 and, if the bucket is empty, waits
+only until the reset time reported by the API instead of a fixed interval.
+
+The clock & sleep functions can be swapped for a SimulatedClock in order to
+replay recorded headers offline via replay_headers(). Headers of a run are
+recorded into its run report (see instrumentation.py) if set in .env:
+
+    RECORD_RATE_LIMITS=1
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+load_dotenv('./.env')
+
+# Keep every response's rate limit headers in RATE_LIMITER.history
+record_headers = os.environ.get("RECORD_RATE_LIMITS", "0") == "1"
+
+# Used if the API doesn't tell when the current window resets
+default_window = 15*60
+
+# Seconds added to each reported reset time to absorb clock skew
+safety_margin = 2
+
+# Spread out requests evenly once less than this share of the limit is left
+pacing_threshold = 0.05
+
+
+def endpoint_key(url) -> str:
+    """Maps an url to its endpoint, e.g. '/2/users/:id/mentions'."""
+    path = urlsplit(url).path
+    return re.sub(r"/\d{3,}", "/:id", path)
+
+
+class Bucket:
+    """Rate limit state of a single endpoint."""
+    __slots__ = ("limit", "remaining", "reset", "in_flight", "lock")
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Token bucket per endpoint. Call acquire(url) before & update(url, ...)
+    after each request. Thread-safe, so concurrent queries share the budget.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep, record=False):
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.history = [] if record else None
+        self.slept = 0.0
+        self._lock = threading.Lock()
+
+    def bucket(self, url) -> Bucket:
+        key = endpoint_key(url)
+        with self._lock:
+            if key not in self.buckets:
+                self.buckets[key] = Bucket()
+            return self.buckets[key]
+
+    def _wait(self, seconds) -> float:
+        if seconds <= 0:
+            return 0.0
+        self.sleep(seconds)
+        self.slept += seconds
+        return seconds
+
+    def acquire(self, url) -> float:
+        """Takes a token for {url}'s endpoint. Returns seconds spent waiting."""
+        b = self.bucket(url)
+        waited = 0.0
+
+        with b.lock:
+            now = self.clock()
+            b.in_flight += 1
+
+            # Window is over -> bucket is full again
+            if b.reset is not None and now >= b.reset:
+                b.remaining, b.reset = b.limit, None
+
+            # Nothing known yet about this endpoint
+            if b.remaining is None:
+                return waited
+
+            # Bucket empty -> wait for the reported reset
+            if b.remaining <= 0:
+                reset = b.reset if b.reset is not None else now + default_window
+                waited += self._wait(reset - now)
+                b.remaining, b.reset = b.limit, None
+
+            # Few tokens left -> spread them over the rest of the window
+            elif b.reset is not None and b.limit and b.remaining <= b.limit * pacing_threshold:
+                waited += self._wait((b.reset - now) / (b.remaining + 1))
+
+            if b.remaining is not None:
+                b.remaining -= 1
+
+        return waited
+
+    def update(self, url, status_code, headers) -> None:
+        """Updates {url}'s bucket from the rate limit headers of a response."""
+        b = self.bucket(url)
+        limit = headers.get("x-rate-limit-limit")
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+
+        with b.lock:
+            b.in_flight = max(0, b.in_flight - 1)
+            if limit is not None:
+                b.limit = int(limit)
+
+            if reset is not None:
+                new_reset = int(reset) + safety_margin
+                new_window = b.reset is None or new_reset > b.reset
+                b.reset = new_reset
+
+                # Other threads may have taken tokens since this response was sent.
+                # Requests still in flight aren't counted in the header of a new window yet.
+                if remaining is not None:
+                    remaining = int(remaining)
+                    if new_window or b.remaining is None:
+                        b.remaining = max(0, remaining - b.in_flight)
+                    else:
+                        b.remaining = min(b.remaining, remaining)
+
+            if status_code == 429:
+                b.remaining = 0
+                if b.reset is None:
+                    b.reset = self.clock() + default_window
+                if b.limit is None:
+                    b.limit = 1
+
+        if self.history is not None:
+            self.history.append({
+                "time": self.clock(),
+                "url": url,
+                "status_code": status_code,
+                "headers": {k: headers[k] for k in
+                    ("x-rate-limit-limit", "x-rate-limit-remaining", "x-rate-limit-reset")
+                    if k in headers},
+            })
+
+    def wait_until_reset(self, url) -> float:
+        """Blocks until {url}'s endpoint window resets. Returns seconds waited."""
+        b = self.bucket(url)
+        with b.lock:
+            now = self.clock()
+            reset = b.reset if b.reset is not None else now + default_window
+            waited = self._wait(reset - now)
+            b.remaining, b.reset = b.limit, None
+        return waited
+
+
+class SimulatedClock:
+    """Stand-in for time.time & time.sleep. Sleeping only advances the clock."""
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds) -> None:
+        self.now += seconds
+
+    def advance(self, seconds) -> None:
+        self.now += seconds
+
+
+def load_history(path) -> list:
+    """Reads recorded headers from a json list or a run report saved with {record_headers}."""
+    with open(path) as f:
+        history = json.load(f)
+    if isinstance(history, dict):
+        history = history.get("rate_limit_history")
+        if history is None:
+            raise ValueError(f"{path} holds no rate limit headers. Record them with RECORD_RATE_LIMITS=1.")
+    return history
+
+
+def replay_headers(history, request_duration=0.5) -> dict:
+    """
+    Replays a recorded RateLimiter.history on a simulated clock. Each response
+    is only handed out once the clock reaches the time it was recorded at, so
+    recorded headers stay valid. Returns how often & how long the limiter slept
+    & how many requests it let through while the recorded headers said the
+    window was used up, i.e. requests the API would have answered with 429.
+    """
+    if history == []:
+        return {"requests": 0, "rate_limited": 0, "would_be_rate_limited": 0,
+            "waits": 0, "slept": 0.0, "elapsed": 0.0}
+
+    clock = SimulatedClock(start=history[0]["time"])
+    limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+    exhausted_until = {}
+    waits = 0
+    violations = 0
+
+    for entry in history:
+        key = endpoint_key(entry["url"])
+        if limiter.acquire(entry["url"]) > 0:
+            waits += 1
+        if clock.now < exhausted_until.get(key, 0):
+            violations += 1
+        clock.advance(request_duration)
+        if clock.now < entry["time"]:
+            clock.now = entry["time"]
+        limiter.update(entry["url"], entry["status_code"], entry["headers"])
+
+        headers = entry["headers"]
+        if entry["status_code"] == 429 or int(headers.get("x-rate-limit-remaining", 1)) <= 0:
+            exhausted_until[key] = int(headers.get("x-rate-limit-reset", clock.now + default_window))
+        else:
+            exhausted_until.pop(key, None)
+
+    return {
+        "requests": len(history),
+        "rate_limited": sum(1 for e in history if e["status_code"] == 429),
+        "would_be_rate_limited": violations,
+        "waits": waits,
+        "slept": limiter.slept,
+        "elapsed": clock.now - history[0]["time"],
+    }
+
+
+RATE_LIMITER = RateLimiter(record=record_headers)
@@ -0,0 +1,265 @@
+"""
+Compact in-memory representation of tweets. The API returns several KB per tweet
+(edit history, the full text & entities repeated in "note_tweet", urls, hashtags
+& annotations...), of which the pipeline uses only a few fields. TweetRecord
+keeps these fields in one list in a fixed order, resolves long tweets on
+construction & keeps only the mentions & urls pointing to media.
+
+Records are mutable mappings, so code indexing tweets like dictionaries works
+unchanged. Fields the record has no place for (e.g. requested via custom query
+parameters) are kept in a small overflow dict. Public metrics are stored as a
+tuple of values with key tuples shared between records. Since all records list
+their fields in the same order, records_to_columns() transposes them at once.
+"""
+
+import gc
+import threading
+import numpy as np
+from operator import itemgetter
+from contextlib import contextmanager
+from collections.abc import Mapping, MutableMapping
+from tweet_cache import user_metrics, user_fields, derived_fields
+
+# Tweet fields used by the pipeline, in the order records list them
+api_fields = [
+    "id",
+    "text",
+    "created_at",
+    "author_id",
+    "conversation_id",
+    "in_reply_to_user_id",
+    "referenced_tweets",
+    "entities",
+]
+
+# API fields never used after construction
+dropped_fields = ["edit_history_tweet_ids", "note_tweet"]
+
+slot_fields = api_fields + user_fields + derived_fields
+_index = {k: i for i, k in enumerate(slot_fields)}
+_known = frozenset(slot_fields + dropped_fields + ["public_metrics"])
+_i_text = _index["text"]
+_i_entities = _index["entities"]
+_i_user = _index[user_fields[0]]
+_get_user_metrics = itemgetter(*user_metrics)
+
+# Key tuples of public_metrics, shared by all records with the same keys
+_metric_keys = {}
+
+# Value of fields the tweet doesn't have
+_missing = object()
+_all_missing = (_missing,) * len(slot_fields)
+
+
+def slim_entities(entities) -> dict:
+    """Keeps the mentions & urls of attached media."""
+    out = {}
+    if "mentions" in entities:
+        out["mentions"] = entities["mentions"]
+    if "urls" in entities:
+        media = [u for u in entities["urls"] if "media_key" in u]
+        if media != []:
+            out["urls"] = media
+    return out
+
+
+class TweetRecord(MutableMapping):
+    """A tweet with its author's user data merged in, indexed like a dictionary."""
+
+    __slots__ = ("_values", "_metrics_keys", "_metrics", "_extra")
+
+    def __init__(self, fields=(), **kwargs):
+        self._values = [_missing] * len(slot_fields)
+        self._metrics_keys = self._metrics = self._extra = None
+        for k, v in dict(fields, **kwargs).items():
+            self[k] = v
+
+    @classmethod
+    def from_api(cls, tweet, user=None) -> "TweetRecord":
+        """
+        Builds a record from a tweet of an API response (or a merged tweet dictionary)
+        & its author from the response's "includes". Long tweets get their full text,
+        mentions & urls from "note_tweet".
+        """
+        r = cls.__new__(cls)
+        get = tweet.get
+        r._values = values = list(map(get, slot_fields, _all_missing))
+
+        metrics = get("public_metrics")
+        if metrics is None:
+            r._metrics_keys = r._metrics = None
+        else:
+            keys = tuple(metrics)
+            r._metrics_keys = _metric_keys.setdefault(keys, keys)
+            r._metrics = tuple(metrics.values())
+        r._extra = None if _known.issuperset(tweet) else {k: v for k, v in tweet.items() if k not in _known}
+
+        note = get("note_tweet")
+        entities = values[_i_entities]
+        if note is not None:
+            values[_i_text] = note["text"]
+            if "entities" in note:
+                entities = dict(entities) if entities is not _missing else {}
+                for k in ("mentions", "urls"):
+                    if k in note["entities"]:
+                        entities[k] = note["entities"][k]
+        if entities is not _missing:
+            values[_i_entities] = slim_entities(entities)
+
+        if user is not None:
+            values[_i_user:_i_user + len(user_fields)] = (user["username"], *_get_user_metrics(user["public_metrics"]))
+
+        return r
+
+    def _set_metrics(self, metrics) -> None:
+        keys = tuple(metrics)
+        self._metrics_keys = _metric_keys.setdefault(keys, keys)
+        self._metrics = tuple(metrics.values())
+
+    def __getitem__(self, key):
+        i = _index.get(key)
+        if i is not None:
+            value = self._values[i]
+            if value is _missing:
+                raise KeyError(key)
+            return value
+        if key == "public_metrics" and self._metrics is not None:
+            return dict(zip(self._metrics_keys, self._metrics))
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value) -> None:
+        i = _index.get(key)
+        if i is not None:
+            self._values[i] = value
+        elif key == "public_metrics":
+            self._set_metrics(value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key) -> None:
+        i = _index.get(key)
+        if i is not None and self._values[i] is not _missing:
+            self._values[i] = _missing
+        elif key == "public_metrics" and self._metrics is not None:
+            self._metrics_keys = self._metrics = None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        i = _index.get(key)
+        if i is not None:
+            return self._values[i] is not _missing
+        if key == "public_metrics":
+            return self._metrics is not None
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        values = self._values
+        for i, k in enumerate(api_fields):
+            if values[i] is not _missing:
+                yield k
+        if self._metrics is not None:
+            yield "public_metrics"
+        for i, k in enumerate(slot_fields[len(api_fields):], len(api_fields)):
+            if values[i] is not _missing:
+                yield k
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"TweetRecord({dict(self)!r})"
+
+    def __getstate__(self) -> dict:
+        return dict(self)
+
+    def __setstate__(self, state) -> None:
+        self.__init__(state)
+
+
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def paused_gc():
+    """
+    Disables the cyclic garbage collector while building many records. Records hold no
+    reference cycles, but each allocation counts towards the next collection, which has
+    to traverse the whole response still held by the caller. Thread-safe & nestable.
+    """
+    global _gc_pauses, _gc_was_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+def as_records(tweets) -> list:
+    """Converts tweet dictionaries (e.g. read from json or the cache) to records. Records are kept."""
+    with paused_gc():
+        return [t if isinstance(t, TweetRecord) else TweetRecord.from_api(t) for t in tweets]
+
+
+def json_default(obj):
+    """default= for json.dump(s): Serializes records (& other mappings) as dictionaries, anything else as str."""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return str(obj)
+
+
+def records_to_columns(records, metrics) -> tuple:
+    """
+    Returns tuple ({column: values}, {metric: int64 array} or None) for a list of records,
+    transposing their value lists instead of reading each record's items. Columns only
+    exist if at least one record has the field, missing values are None. The {metrics} are
+    flattened into arrays if all records have them, else public_metrics stays a column.
+    """
+    n = len(records)
+    columns = {}
+
+    # Transpose all fields at once, then drop fields no record has
+    for k, values in zip(slot_fields, zip(*[r._values for r in records])):
+        n_missing = values.count(_missing)
+        if n_missing == 0:
+            columns[k] = list(values)
+        elif n_missing < n:
+            columns[k] = [None if v is _missing else v for v in values]
+
+    for i, r in enumerate(records):
+        if r._extra is None:
+            continue
+        for k, v in r._extra.items():
+            if k not in columns:
+                columns[k] = [None] * n
+            columns[k][i] = v
+
+    flat = None
+    n_with_metrics = sum(1 for r in records if r._metrics is not None)
+    keys = records[0]._metrics_keys if n > 0 else None
+
+    if n_with_metrics == n and n > 0 and all(m in keys for m in metrics) and \
+        all(r._metrics_keys == keys for r in records):
+        values = np.array([r._metrics for r in records], dtype="int64")
+        flat = {m: values[:, keys.index(m)].copy() for m in metrics}
+    elif n_with_metrics > 0:
+        columns["public_metrics"] = [r.get("public_metrics") for r in records]
+
+    return (columns, flat)
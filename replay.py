@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rebuilds the database from archived API responses (see archive.py) & the json
+backups of earlier versions, without querying the API. Use it to re-derive the
+dataset after changing {filter_patterns}, discount_mentions() or the pandas
+pipeline in main.py.
+
+Files are read by worker processes, one file per worker, in three passes so that
+only one file's tweets are held at a time:
+1. Each file's mentions & quotes are filtered. Workers only return the ids of the
+   tweets replied to & the ids of the tweets that could serve as their parents.
+2. The files holding parents are read again. Workers return only these parents,
+   which are added to the tweet cache (as expired, existing entries are kept).
+3. Each file is filtered again & its tweets pass through discount_mentions() &
+   transform() & are saved, oldest file first. Only a few files are read ahead.
+Parents missing from the archive are served from the cache only & media tags only
+from the media tag store; nothing is queried or scraped.
+
+The parents are added to the live tweet cache (TWEET_CACHE_PATH), unless --cache
+points elsewhere; a copy keeps the live cache untouched, a new file leaves only
+the archive's parents. Discarded tweets are logged to {replay_discard_log_path},
+not to the live discard log, unless --discard-log says otherwise.
+
+    python replay.py [--out <sqlite path>] [--workers <n>] [--cache <sqlite path>]
+        [--discard-log <sqlite path>] [<archive or json path> ...]
+
+Without paths, replays all json backups ({backup_glob}) & all archive files.
+"""
+
+import os
+import argparse
+from glob import glob
+from collections import deque
+from contextlib import contextmanager
+from os.path import basename, getmtime
+from concurrent.futures import ProcessPoolExecutor
+import query_and_filter
+from query_and_filter import de_truncate, discount_mentions, save_discarded, filter_patterns, merge_user_data
+from filter_engine import classify_tweets
+from archive import iter_archive, archive_files, backup_name
+from helpers import read_list_from_json
+from records import as_records
+from storage import upsert_tweets
+from tweet_cache import TWEET_CACHE
+from discard_log import DISCARD_LOG
+from main import transform
+
+replay_path = "./Force_Wielders_Data_replay.sqlite"
+replay_discard_log_path = "./discarded_tweets_replay.sqlite"
+backup_glob = "./*unfiltered*.json"
+replay_workers = max(1, int(os.environ.get("REPLAY_WORKERS", os.cpu_count() or 1)))
+
+# Batches holding the tweets of the dataset. All others (parents, the account's own tweets) are only looked up.
+dataset_sources = ["get_new_mentions()", "get_new_quote_tweets()", "get_quotes_for_tweet()"]
+
+
+def replay_files() -> list:
+    """Json backups (oldest first), then archive files (oldest month first)."""
+    return sorted(glob(backup_glob), key=getmtime) + archive_files()
+
+
+def iter_file(path):
+    """
+    Yields tuple (function name, tweets) per batch of an archive file or json backup.
+    Archived API pages are merged with their users like fresh responses.
+    """
+    if path.endswith(".json"):
+        batches = [{"name": backup_name(path), "tweets": read_list_from_json(path)}]
+    else:
+        batches = iter_archive([path])
+
+    for batch in batches:
+        name = batch["name"]
+        if "tweets" in batch:
+            yield (name, as_records(batch["tweets"]))
+        else:
+            yield (name, merge_user_data(batch["data"], batch["includes"]["users"]))
+
+
+def is_parent(tweet) -> bool:
+    """True if {tweet} has all a cached parent needs (user data & metrics)."""
+    return "username" in tweet and "public_metrics" in tweet
+
+
+def read_file(path, parent_ids=()) -> tuple:
+    """
+    Reads one archive file or json backup & applies {filter_patterns} to its mentions &
+    quotes. Runs in a worker process, so it doesn't touch any database. Returns tuple
+    (kept tweets, {filter name: [discarded tweets]}, {id: tweet} of its tweets in
+    {parent_ids} that can be cached as parents, all of them if None). A tweet archived
+    several times is kept in its latest version.
+    """
+    dataset, parents = {}, {}
+    for name, tweets in iter_file(path):
+        for t in tweets:
+            if name in dataset_sources:
+                t.setdefault("source", name)
+                dataset[t["id"]] = t
+            if (parent_ids is None or t["id"] in parent_ids) and is_parent(t):
+                parents[t["id"]] = t
+
+    tweets = de_truncate(list(dataset.values()))
+    kept, discarded = classify_tweets(tweets, filter_patterns)
+    return (kept, discarded, parents)
+
+
+def replied_to(tweets) -> set:
+    """Ids of the tweets replied to by {tweets}."""
+    return {
+        ref["id"] for t in tweets for ref in t.get("referenced_tweets") or []
+        if ref["type"] == "replied_to"
+    }
+
+
+def scan_file(path) -> tuple:
+    """
+    First pass over one file (in a worker process). Returns tuple (ids replied to by
+    its kept tweets, ids of its tweets that can be cached as parents).
+    """
+    kept, _, parents = read_file(path, parent_ids=None)
+    return (replied_to(kept), set(parents))
+
+
+def find_parents(path, ids) -> list:
+    """Second pass over one file (in a worker process). Returns its tweets with {ids} that can be cached as parents."""
+    parents = {}
+    for _, tweets in iter_file(path):
+        parents.update((t["id"], t) for t in tweets if t["id"] in ids and is_parent(t))
+    return list(parents.values())
+
+
+def ordered_map(executor, func, items, window):
+    """
+    Like executor.map(), but submits at most {window} calls ahead of the consumer, so
+    results not consumed yet don't pile up in memory.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+@contextmanager
+def stores_at(cache_path=None, discard_log_path=None):
+    """Points TWEET_CACHE & DISCARD_LOG at other files (if not None). Restores them after."""
+    moved = [(store, path) for store, path in ((TWEET_CACHE, cache_path), (DISCARD_LOG, discard_log_path))
+        if path is not None]
+    previous = [(store, store.path) for store, _ in moved]
+    for store, path in moved:
+        store.close()
+        store.path = path
+    try:
+        yield
+    finally:
+        for store, path in previous:
+            store.close()
+            store.path = path
+
+
+@contextmanager
+def offline():
+    """Keeps query_and_filter from querying the API (e.g. for missing parents). Restores it after."""
+    previous = query_and_filter.offline
+    query_and_filter.offline = True
+    try:
+        yield
+    finally:
+        query_and_filter.offline = previous
+
+
+def replay(paths, out_path=replay_path, max_workers=replay_workers, cache_path=None,
+           discard_log_path=replay_discard_log_path) -> int:
+    """
+    Replays {paths} into the database at {out_path}. Parents are added to the tweet cache
+    at {cache_path} (None: the live cache), discarded tweets logged to {discard_log_path}
+    (None: the live discard log). Returns number of newly added tweets.
+    """
+    n_workers = max(1, min(max_workers, len(paths)))
+    n_rows = 0
+
+    with offline(), stores_at(cache_path, discard_log_path), ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+        # Parents are often archived in another file than their replies (e.g. get_tweets() lookups)
+        needed, found_in = set(), {}
+        for i, (reply_ids, parent_ids) in enumerate(executor.map(scan_file, paths)):
+            needed |= reply_ids
+            found_in.update(dict.fromkeys(parent_ids, i))
+
+        by_file = {}
+        for _id in needed:
+            if _id in found_in:
+                by_file.setdefault(found_in[_id], set()).add(_id)
+        del found_in
+
+        files = sorted(by_file)
+        parents = {}
+        for found in executor.map(find_parents, [paths[i] for i in files], [by_file[i] for i in files]):
+            parents.update((t["id"], t) for t in found)
+        TWEET_CACHE.put_many(parents.values(), metrics_at=0, replace=False)
+        print(f"Read {len(paths)} files. Found {len(parents)} parent tweets in the archive.")
+        del parents
+
+        for path, (kept, discarded, _) in zip(paths, ordered_map(executor, read_file, paths, n_workers)):
+            save_discarded(discarded, None)
+
+            tweets = discount_mentions({t["id"]: t for t in kept})
+            n_file = upsert_tweets(transform(tweets), out_path) if tweets != {} else 0
+            n_rows += n_file
+            print(f"{basename(path)}: {len(kept)} tweets passed the filters, {len(tweets)} kept, {n_file} new.")
+
+    return n_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the database from archived tweets without querying the API.")
+    parser.add_argument("paths", nargs="*", help="Archive files or json backups (default: all).")
+    parser.add_argument("--out", default=replay_path, help="Database to write to.")
+    parser.add_argument("--workers", type=int, default=replay_workers, help="Files read in parallel.")
+    parser.add_argument("--cache", default=None, help="Tweet cache to add parents to (default: the live cache).")
+    parser.add_argument("--discard-log", default=replay_discard_log_path, help="Discard log to write to.")
+    args = parser.parse_args()
+
+    paths = args.paths or replay_files()
+    if paths == []:
+        print("Nothing to replay. No archive files or json backups found.")
+    else:
+        n_rows = replay(paths, args.out, args.workers, args.cache, args.discard_log)
+        print(f"\nReplayed {len(paths)} files. Added {n_rows} tweets to {args.out}")
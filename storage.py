@@ -0,0 +1,459 @@
+"""
+Incremental tweet database. Tweets are stored in SQLite with a primary key on
+the tweet id, so saving new tweets costs O(new rows) instead of rewriting all
+known data. Per tweet id only the version with the most impressions is kept.
+Column dtypes are kept in a separate table & restored when loading. A column
+is re-encoded as json once a batch holds values its stored kind can't hold.
+
+Tweets are partitioned by the month they count for ("YYYY-MM" in column
+"month"), which is indexed, so loading one month only reads that month's rows.
+
+The newest known tweet id per query function (the point until which the next
+run queries back in time) is kept in a small watermark table. It is updated in
+the same transaction as the tweets, so reading it at startup is O(1). Runs
+saving tweets in batches only move it forward once all batches are saved.
+
+If executed directly, exports the database to the old csv format, imports a
+csv database, recomputes the watermarks from all stored tweets or lists the
+stored months:
+
+    python storage.py export [<csv path>]
+    python storage.py import <csv path>
+    python storage.py rebuild-cutoffs
+    python storage.py months
+"""
+
+import json
+import sqlite3
+import argparse
+import pandas as pd
+from ast import literal_eval
+from os.path import exists
+from helpers import csv_to_df, df_to_csv
+from instrumentation import timed
+from pandas_pipes import add_month
+
+db_path = "./Force_Wielders_Data_beta.sqlite"
+csv_export_path = "./Force_Wielders_Data_beta.csv"
+
+# Columns holding lists in the old csv database (stored there as python literals)
+literal_columns = ["referenced_tweets", "discounted_mentions"]
+
+# Newer versions of a tweet only replace stored ones if they have at least as many views
+keep_max_of = "impression_count"
+
+# Column the tweets are partitioned by (year & month, e.g. "2023-12")
+partition_column = "month"
+
+# Version of the table layout, stored as PRAGMA user_version. Older databases are migrated on connect.
+layout_version = 1
+
+# Values of column "source" the cutoff watermarks are kept for
+mentions_source = "get_new_mentions()"
+quotes_source = "get_quotes_for_tweet()"
+
+schema = """
+CREATE TABLE IF NOT EXISTS columns (
+    name TEXT PRIMARY KEY,
+    dtype TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cutoffs (
+    source TEXT PRIMARY KEY,
+    tweet_id TEXT NOT NULL
+);
+"""
+
+
+def connect(path=db_path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.executescript(schema)
+    migrate(conn)
+
+    # Database predates the watermark table -> compute the watermarks once from its tweets
+    if "columns" in tables and "cutoffs" not in tables:
+        with conn:
+            advance_cutoffs(conn, compute_cutoffs(read_tweets(conn, ["id", "source", "referenced_tweets"])))
+    return conn
+
+
+def migrate(conn) -> None:
+    """
+    Upgrades databases written by older versions. Version 1 replaces the bare month
+    names ("December") by year-month keys derived from the tweet time & indexes them.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= layout_version:
+        return
+
+    columns = get_columns(conn)
+    with conn:
+        if partition_column in columns and "parsed_time" in columns:
+            conn.execute(
+                f"UPDATE tweets SET {quote(partition_column)} = substr(parsed_time, 1, 7) "
+                "WHERE parsed_time IS NOT NULL"
+            )
+        index_partitions(conn, columns)
+        conn.execute(f"PRAGMA user_version = {layout_version}")
+
+
+def index_partitions(conn, columns) -> None:
+    if partition_column in columns:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS tweets_{partition_column} ON tweets ({quote(partition_column)})")
+
+
+def quote(name) -> str:
+    """Quotes a column name for use in SQL."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def column_kind(series) -> str:
+    """
+    Returns how a column is stored: "datetime", "number", "bool", "text" for
+    object columns holding only strings, "json" for any other object column,
+    including columns holding no values yet (e.g. optional fields no tweet had).
+    """
+    dtype = str(series.dtype)
+    if "date" in dtype:
+        return "datetime"
+    if dtype == "bool":
+        return "bool"
+    if dtype.startswith(("int", "uint", "float")):
+        return "number"
+    if all(v is None for v in series):
+        return "json"
+    if all(isinstance(v, str) or v is None for v in series):
+        return "text"
+    return "json"
+
+
+def fits(series, kind) -> bool:
+    """True if {series} can be stored as {kind} without changing its values."""
+    dtype = str(series.dtype)
+    if kind == "json":
+        return True
+    if kind == "datetime":
+        return "date" in dtype
+    if kind == "bool":
+        return dtype == "bool"
+    if kind == "number":
+        return dtype.startswith(("int", "uint", "float"))
+    return all(isinstance(v, str) or v is None for v in series)
+
+
+def widen_column(conn, name, kind) -> None:
+    """
+    Re-encodes the stored values of column {name} (stored as {kind}) as json, so it can
+    hold any value. Needed once a later batch holds values the first batch didn't have.
+    """
+    c = quote(name)
+    rows = conn.execute(f"SELECT id, {c} FROM tweets WHERE {c} IS NOT NULL").fetchall()
+    to_value = bool if kind == "bool" else (lambda v: v)
+    conn.executemany(
+        f"UPDATE tweets SET {c} = ? WHERE id = ?",
+        [(json.dumps(to_value(v), default=str), _id) for _id, v in rows],
+    )
+    conn.execute("UPDATE columns SET dtype = 'object', kind = 'json' WHERE name = ?", (name,))
+
+
+def get_columns(conn) -> dict:
+    """Returns {name: (dtype, kind)} of all stored columns, in stored order."""
+    rows = conn.execute("SELECT name, dtype, kind FROM columns ORDER BY position")
+    return {name: (dtype, kind) for name, dtype, kind in rows}
+
+
+def ensure_columns(conn, df) -> dict:
+    """
+    Creates the tweets table or adds columns of {df} it doesn't have yet. Stored columns
+    {df} holds values of another kind for are widened to json.
+    """
+    known = get_columns(conn)
+    sql_types = {"datetime": "TEXT", "number": "NUMERIC", "bool": "INTEGER", "text": "TEXT", "json": "TEXT"}
+
+    if known == {}:
+        if "id" not in df.columns:
+            raise ValueError("Tweets need an 'id' column.")
+        known = {c: (str(df[c].dtype), column_kind(df[c])) for c in df.columns}
+        col_defs = [
+            f"{quote(c)} {sql_types[kind]}" + (" PRIMARY KEY" if c == "id" else "")
+            for c, (dtype, kind) in known.items()
+        ]
+        conn.execute(f"CREATE TABLE tweets ({', '.join(col_defs)})")
+        conn.executemany(
+            "INSERT INTO columns VALUES (?, ?, ?, ?)",
+            [(c, dtype, kind, i) for i, (c, (dtype, kind)) in enumerate(known.items())],
+        )
+        index_partitions(conn, known)
+        return known
+
+    for c in df.columns:
+        if c in known:
+            if not fits(df[c], known[c][1]):
+                widen_column(conn, c, known[c][1])
+                known[c] = ("object", "json")
+            continue
+        dtype, kind = str(df[c].dtype), column_kind(df[c])
+        conn.execute(f"ALTER TABLE tweets ADD COLUMN {quote(c)} {sql_types[kind]}")
+        conn.execute("INSERT INTO columns VALUES (?, ?, ?, ?)", (c, dtype, kind, len(known)))
+        known[c] = (dtype, kind)
+
+    index_partitions(conn, known)
+    return known
+
+
+def encode_column(series, kind) -> list:
+    """Converts a column to a list of values sqlite3 can store."""
+    if kind == "datetime":
+        return [None if pd.isna(v) else str(v) for v in series]
+    if kind == "json":
+        return [json.dumps(v, default=str) for v in series]
+    if kind == "text":
+        return [v if (v is None or isinstance(v, str)) else str(v) for v in series]
+    if kind == "bool":
+        return [int(v) for v in series]
+    return series.tolist()
+
+
+def decode_column(series, dtype, kind) -> pd.Series:
+    """Restores a column loaded from sqlite to its original dtype."""
+    if kind == "datetime":
+        return pd.to_datetime(series, utc="UTC" in dtype)
+    if kind == "json":
+        # Numeric columns widened to json store json numbers as numbers (column affinity)
+        return series.map(lambda v: json.loads(v) if isinstance(v, str) else v)
+    if kind == "bool":
+        return series.astype(bool)
+    if kind == "number":
+        try:
+            return series.astype(dtype)
+        except (TypeError, ValueError):
+            return series
+    return series
+
+
+def compute_cutoffs(df) -> dict:
+    """
+    Returns a dictionary of type {func_1: "<highest tweet id>", ...} for the tweets
+    in {df}: the newest mention & the newest JediSwap tweet that has been quoted.
+    """
+    cutoff_d = {}
+    if "source" not in df.columns:
+        return cutoff_d
+
+    # Get most recent mention, skip if none found
+    mentions = df.loc[df["source"] == mentions_source, "id"].tolist()
+    if mentions != []:
+        cutoff_d[mentions_source] = max(mentions, key=int)
+
+    # Get ids of quoted JediSwap tweets, skip if none found
+    js_tweet_ids = set()
+    if "referenced_tweets" in df.columns:
+        for l in df.loc[df["source"] == quotes_source, "referenced_tweets"]:
+            referenced_tweets_list = literal_eval(l) if isinstance(l, str) else l
+            for t in referenced_tweets_list:
+                if t["type"] == "quoted":
+                    js_tweet_ids.add(t["id"])
+
+    if js_tweet_ids != set():
+        cutoff_d[quotes_source] = max(js_tweet_ids, key=int)
+
+    return cutoff_d
+
+
+def advance_cutoffs(conn, cutoff_d) -> None:
+    """Moves stored watermarks forward to the ids in {cutoff_d}. Never moves them back."""
+    conn.executemany(
+        "INSERT INTO cutoffs VALUES (?, ?) ON CONFLICT(source) DO UPDATE SET "
+        "tweet_id = excluded.tweet_id "
+        "WHERE CAST(excluded.tweet_id AS INTEGER) > CAST(cutoffs.tweet_id AS INTEGER)",
+        [(str(k), str(v)) for k, v in cutoff_d.items()],
+    )
+
+
+def save_cutoffs(cutoff_d, path=db_path) -> None:
+    """Moves the stored watermarks forward to the ids in {cutoff_d}."""
+    conn = connect(path)
+    try:
+        with conn:
+            advance_cutoffs(conn, cutoff_d)
+    finally:
+        conn.close()
+
+
+def read_cutoffs(path=db_path) -> dict:
+    """
+    Returns the stored watermarks. Empty if no run has completed yet, even if tweets are
+    stored: these may be the first pages of an unfinished query, not all tweets up to them.
+    Databases predating the watermarks get them computed once on connect().
+    """
+    conn = connect(path)
+    try:
+        return dict(conn.execute("SELECT source, tweet_id FROM cutoffs"))
+    finally:
+        conn.close()
+
+
+def rebuild_cutoffs(path=db_path) -> dict:
+    """Recomputes the watermarks from all stored tweets & replaces the stored ones."""
+    df = load_tweets(path, columns=["id", "source", "referenced_tweets"])
+    cutoff_d = compute_cutoffs(df)
+
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM cutoffs")
+            advance_cutoffs(conn, cutoff_d)
+    finally:
+        conn.close()
+    return cutoff_d
+
+
+@timed("db_write")
+def upsert_tweets(df, path=db_path, update_cutoffs=True) -> int:
+    """
+    Inserts tweets from {df} into the database, replacing known tweets if the new
+    version has at least as many impressions. Advances the cutoff watermarks in the
+    same transaction, unless {update_cutoffs} is False (e.g. while a run saves its
+    tweets in several batches). Returns number of newly added tweets.
+    """
+    if df.shape[0] == 0:
+        return 0
+
+    conn = connect(path)
+    try:
+        with conn:
+            columns = ensure_columns(conn, df)
+            cols = list(df.columns)
+            values = zip(*[encode_column(df[c], columns[c][1]) for c in cols])
+
+            # Count tweets not stored yet
+            ids = [str(i) for i in df["id"]]
+            n_known = 0
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                n_known += conn.execute(
+                    f"SELECT COUNT(*) FROM tweets WHERE id IN ({','.join('?'*len(chunk))})", chunk
+                ).fetchone()[0]
+
+            col_list = ", ".join(quote(c) for c in cols)
+            updates = ", ".join(f"{quote(c)} = excluded.{quote(c)}" for c in cols if c != "id")
+            condition = ""
+            if keep_max_of in cols:
+                k = quote(keep_max_of)
+                condition = f" WHERE excluded.{k} >= tweets.{k} OR tweets.{k} IS NULL"
+
+            conn.executemany(
+                f"INSERT INTO tweets ({col_list}) VALUES ({', '.join('?'*len(cols))}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates}{condition}",
+                values,
+            )
+            if update_cutoffs:
+                advance_cutoffs(conn, compute_cutoffs(df))
+    finally:
+        conn.close()
+
+    return len(set(ids)) - n_known
+
+
+@timed("db_read")
+def load_tweets(path=db_path, columns=None, where=None, params=()) -> pd.DataFrame:
+    """
+    Loads tweets from the database with their original dtypes. Loads only
+    {columns} if given. Rows can be restricted by an sql {where} clause.
+    """
+    conn = connect(path)
+    try:
+        return read_tweets(conn, columns, where, params)
+    finally:
+        conn.close()
+
+
+def read_tweets(conn, columns=None, where=None, params=()) -> pd.DataFrame:
+    """load_tweets() on an open connection."""
+    known = get_columns(conn)
+    columns = list(known) if columns is None else [c for c in columns if c in known]
+    if known == {}:
+        return pd.DataFrame(columns=columns)
+
+    query = f"SELECT {', '.join(quote(c) for c in columns)} FROM tweets"
+    if where:
+        query += f" WHERE {where}"
+    df = pd.read_sql_query(query + " ORDER BY id", conn, params=params)
+
+    for c in columns:
+        dtype, kind = known[c]
+        df[c] = decode_column(df[c], dtype, kind)
+    return df
+
+
+def load_month(month, path=db_path, columns=None) -> pd.DataFrame:
+    """Loads the tweets of one {month} ("YYYY-MM") via the partition index."""
+    return load_tweets(path, columns, where=f"{quote(partition_column)} = ?", params=(month,))
+
+
+def list_months(path=db_path) -> dict:
+    """Returns {month: number of tweets} of all stored months."""
+    conn = connect(path)
+    try:
+        if partition_column not in get_columns(conn):
+            return {}
+        col = quote(partition_column)
+        return dict(conn.execute(f"SELECT {col}, COUNT(*) FROM tweets GROUP BY {col} ORDER BY {col}"))
+    finally:
+        conn.close()
+
+
+def import_csv(csv_path, path=db_path) -> int:
+    """Adds all tweets from a csv database written by df_to_csv(). Returns number of new tweets."""
+    df = csv_to_df(csv_path)
+
+    def parse_literal(v):
+        if isinstance(v, str) and (v.startswith("[") or v in ("True", "False")):
+            return literal_eval(v)
+        return v
+
+    for c in literal_columns:
+        if c in df.columns:
+            df[c] = df[c].map(parse_literal)
+
+    # Old csv databases hold bare month names
+    if partition_column in df.columns and "parsed_time" in df.columns:
+        df = add_month(df)
+
+    return upsert_tweets(df, path)
+
+
+def export_csv(csv_path=csv_export_path, path=db_path) -> int:
+    """Writes the whole database to {csv_path} in the old csv format. Returns number of rows."""
+    df = load_tweets(path)
+    df_to_csv(df, csv_path, mode="w", sep=",")
+    return df.shape[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the tweet database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Export database to csv.")
+    export.add_argument("csv_path", nargs="?", default=csv_export_path)
+    _import = commands.add_parser("import", help="Add tweets from a csv database.")
+    _import.add_argument("csv_path")
+    commands.add_parser("rebuild-cutoffs", help="Recompute cutoff watermarks from all tweets.")
+    commands.add_parser("months", help="List stored months & their number of tweets.")
+    args = parser.parse_args()
+
+    assert exists(db_path) or args.command == "import", f"No database found in {db_path}."
+
+    if args.command == "export":
+        n_rows = export_csv(args.csv_path)
+        print(f"Exported {n_rows} tweets to", args.csv_path.lstrip("./"))
+    elif args.command == "import":
+        n_rows = import_csv(args.csv_path)
+        print(f"Imported {n_rows} new tweets from", args.csv_path.lstrip("./"))
+    elif args.command == "rebuild-cutoffs":
+        for k, v in rebuild_cutoffs().items():
+            print(f"{k}\t{v}")
+    elif args.command == "months":
+        for month, n_tweets in list_months().items():
+            print(f"{month}\t{n_tweets}")
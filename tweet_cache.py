@@ -0,0 +1,286 @@
+"""
+Persistent cache of tweet & user payloads returned by the Twitter API, stored
+in SQLite. Tweet text, entities & all other static fields never expire. Public
+metrics of tweets & users expire after {metrics_ttl} seconds. Path & TTL can be
+set in .env:
+
+    TWEET_CACHE_PATH=./tweet_cache.sqlite
+    TWEET_CACHE_METRICS_TTL=86400
+
+The same database holds the users tagged in the media of scraped tweets. Failed
+scrapes are remembered & only retried after an exponentially growing backoff.
+If executed directly, media tags can be invalidated so they get scraped again:
+
+    python tweet_cache.py invalidate-media <tweet id> [<tweet id> ...]
+    python tweet_cache.py invalidate-media --failed
+    python tweet_cache.py invalidate-media --all
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+from dotenv import load_dotenv
+load_dotenv('./.env')
+
+cache_path = os.environ.get("TWEET_CACHE_PATH", "./tweet_cache.sqlite")
+metrics_ttl = int(os.environ.get("TWEET_CACHE_METRICS_TTL", 24*60*60))
+
+# Wait after the 1st failed scrape of a tweet. Doubles with each further failure.
+scrape_backoff = 6*60*60
+max_scrape_backoff = 30*24*60*60
+
+# Fields copied onto each tweet by merge_user_data()
+user_metrics = ["followers_count", "following_count", "tweet_count", "listed_count"]
+user_fields = ["username"] + user_metrics
+
+# Fields added to tweets by the pipeline. Not part of the API payload.
+derived_fields = ["source", "comment", "discounted_mentions", "tagged_users_list"]
+
+schema = """
+CREATE TABLE IF NOT EXISTS tweets (
+    id TEXT PRIMARY KEY,
+    author_id TEXT,
+    data TEXT NOT NULL,
+    public_metrics TEXT,
+    metrics_at REAL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    public_metrics TEXT,
+    metrics_at REAL
+);
+CREATE TABLE IF NOT EXISTS media_tags (
+    tweet_id TEXT PRIMARY KEY,
+    tagged_users TEXT,
+    scraped_at REAL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL
+);
+"""
+
+
+def connect(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    return conn
+
+
+class TweetCache:
+    """
+    Keyed store of tweets (joined with their author on read). get_many() counts
+    hits & misses. Entries with stale metrics only count as hits if the caller
+    doesn't need metrics.
+    """
+
+    def __init__(self, path=cache_path, metrics_ttl=metrics_ttl, clock=time.time):
+        self.path = path
+        self.metrics_ttl = metrics_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = connect(self.path)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_many(self, ids, need_metrics=True) -> dict:
+        """Returns {id: tweet} for all cached ids in {ids}. Updates hit/miss stats."""
+        ids = list(dict.fromkeys(str(i) for i in ids))
+        oldest = self.clock() - self.metrics_ttl
+        found = {}
+
+        # Stay below SQLite's limit of host parameters per statement
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            rows = self.conn.execute(
+                "SELECT t.id, t.data, t.public_metrics, t.metrics_at, "
+                "u.username, u.public_metrics, u.metrics_at "
+                "FROM tweets t LEFT JOIN users u ON t.author_id = u.id "
+                f"WHERE t.id IN ({','.join('?'*len(chunk))})",
+                chunk,
+            )
+            for _id, data, metrics, metrics_at, username, u_metrics, u_metrics_at in rows:
+                if username is None:
+                    continue
+                if need_metrics and (metrics_at < oldest or u_metrics_at < oldest):
+                    continue
+
+                tweet = json.loads(data)
+                tweet["public_metrics"] = json.loads(metrics)
+                tweet["username"] = username
+                tweet.update(json.loads(u_metrics))
+                found[_id] = tweet
+
+        self.hits += len(found)
+        self.misses += len(ids) - len(found)
+        return found
+
+    def put_many(self, tweets, metrics_at=None, replace=True) -> None:
+        """
+        Stores tweets as merged by merge_user_data(). Overwrites known ids unless {replace}
+        is False. Metrics count as fetched at {metrics_at} (default: now), so older data
+        (e.g. from archived backups) can be stored with metrics that are already expired.
+        """
+        now = self.clock() if metrics_at is None else metrics_at
+        insert = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        tweet_rows = []
+        user_rows = {}
+        skip = set(user_fields + derived_fields + ["public_metrics"])
+
+        for t in tweets:
+            data = {k: v for k, v in t.items() if k not in skip}
+            tweet_rows.append((
+                t["id"],
+                t["author_id"],
+                json.dumps(data),
+                json.dumps(t["public_metrics"]),
+                now,
+            ))
+            user_rows[t["author_id"]] = (
+                t["author_id"],
+                t["username"],
+                json.dumps({k: t[k] for k in user_metrics}),
+                now,
+            )
+
+        with self.conn:
+            self.conn.executemany(f"{insert} INTO tweets VALUES (?, ?, ?, ?, ?)", tweet_rows)
+            self.conn.executemany(f"{insert} INTO users VALUES (?, ?, ?, ?)", user_rows.values())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+class MediaTagStore:
+    """
+    Users tagged in the media of a tweet, keyed by tweet id. Tags of a posted
+    tweet practically never change, so successful scrapes never expire. Scrapes
+    that found nobody are treated as failed, since the media tags modal of a tweet
+    always lists someone. They're retried after the backoff.
+    """
+
+    def __init__(self, path=cache_path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = connect(self.path)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def lookup(self, tweet_ids) -> tuple:
+        """
+        Returns tuple (known, backing_off): a dictionary {tweet_id: tagged_users_list}
+        of all scraped tweets & a set of tweet ids whose last scrape failed too recently.
+        """
+        tweet_ids = list(dict.fromkeys(str(i) for i in tweet_ids))
+        now = self.clock()
+        known = {}
+        backing_off = set()
+
+        for i in range(0, len(tweet_ids), 500):
+            chunk = tweet_ids[i:i+500]
+            rows = self.conn.execute(
+                "SELECT tweet_id, tagged_users, retry_at FROM media_tags "
+                f"WHERE tweet_id IN ({','.join('?'*len(chunk))})",
+                chunk,
+            )
+            for tweet_id, tagged_users, retry_at in rows:
+
+                # Empty lists stored by earlier versions are scraped again
+                if tagged_users is not None and tagged_users != "[]":
+                    known[tweet_id] = json.loads(tagged_users)
+                elif retry_at is not None and retry_at > now:
+                    backing_off.add(tweet_id)
+
+        return (known, backing_off)
+
+    def put(self, tweet_id, tagged_users_list) -> None:
+        """Stores the users tagged in a tweet's media for good. Empty lists count as failed scrapes."""
+        if tagged_users_list == []:
+            self.record_failure(tweet_id)
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO media_tags VALUES (?, ?, ?, 0, NULL)",
+                (str(tweet_id), json.dumps(tagged_users_list), self.clock()),
+            )
+
+    def record_failure(self, tweet_id) -> float:
+        """Counts a failed scrape of {tweet_id}. Returns time of the next allowed retry."""
+        row = self.conn.execute(
+            "SELECT failures FROM media_tags WHERE tweet_id = ?", (str(tweet_id),)
+        ).fetchone()
+        failures = (row[0] if row else 0) + 1
+        now = self.clock()
+        retry_at = now + min(scrape_backoff * 2**(failures-1), max_scrape_backoff)
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO media_tags VALUES (?, NULL, ?, ?, ?)",
+                (str(tweet_id), now, failures, retry_at),
+            )
+        return retry_at
+
+    def invalidate(self, tweet_ids=None, failed_only=False) -> int:
+        """
+        Forgets media tags of {tweet_ids} (all tweets if None). With {failed_only},
+        only clears failed scrapes. Returns number of removed entries.
+        """
+        where = ["1"]
+        args = []
+        if failed_only:
+            where.append("tagged_users IS NULL")
+        if tweet_ids is not None:
+            tweet_ids = [str(i) for i in tweet_ids]
+            where.append(f"tweet_id IN ({','.join('?'*len(tweet_ids))})")
+            args.extend(tweet_ids)
+
+        with self.conn:
+            cursor = self.conn.execute(f"DELETE FROM media_tags WHERE {' AND '.join(where)}", args)
+        return cursor.rowcount
+
+
+TWEET_CACHE = TweetCache()
+MEDIA_TAGS = MediaTagStore()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the tweet cache.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    invalidate = commands.add_parser("invalidate-media", help="Scrape media tags again on next run.")
+    invalidate.add_argument("tweet_ids", nargs="*", help="Tweet ids to invalidate.")
+    invalidate.add_argument("--failed", action="store_true", help="Only clear failed scrapes.")
+    invalidate.add_argument("--all", action="store_true", help="Invalidate all tweets.")
+    args = parser.parse_args()
+
+    if args.command == "invalidate-media":
+        if args.tweet_ids == [] and not (args.all or args.failed):
+            parser.error("Pass tweet ids, --failed or --all.")
+        tweet_ids = args.tweet_ids if args.tweet_ids != [] else None
+        n_removed = MEDIA_TAGS.invalidate(tweet_ids, failed_only=args.failed)
+        print(f"Invalidated media tags of {n_removed} tweets.")